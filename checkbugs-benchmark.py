@@ -0,0 +1,258 @@
+#!/usr/bin/python3
+
+"""
+Times checkbugs.main() phase by phase, without touching Bugzilla, Gerrit or
+the local git clone.
+
+Either replay responses recorded with checkbugs.py --record, or generate a
+synthetic milestone with thousands of bugs, changes and commits. Synthetic
+Bugzilla and Gerrit queries are answered from memory (optionally with some
+added latency per request, to stand in for the network) and git commands are
+run against a generated repo.
+"""
+
+import contextlib
+import importlib
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+import checkbugs
+
+# Functions which checkbugs.main() calls through the module, so they can be
+# wrapped to time each phase
+PHASES = [
+    'build_git_revlist',
+    'bugs_referenced_in_commits',
+    'get_bugs',
+    'get_bugs_by_id',
+    'get_gerrit_changes',
+    'print_bug_summary',
+    'check_bug',
+    'check_referenced_bugs',
+    'check_in_work_bugs',
+]
+
+# Gerrit's default query limit
+GERRIT_PAGE_SIZE = 500
+
+
+class SyntheticBackend(object):
+    """
+    Backend for checkbugs (see checkbugs.FixtureBackend) which makes up a
+    milestone's worth of bugs, changes and commits.
+    """
+
+    def __init__(self, repo_dir, milestone, bugs=2000, changes_per_bug=3, commits=20000,
+                 latency=0):
+        self.latency = latency
+        rand = random.Random(1)
+        bug_ids = list(range(1000000, 1000000 + bugs))
+        # Bugs from other milestones, which commits on the branch refer to
+        other_bug_ids = list(range(2000000, 2000000 + bugs // 10 + 1))
+        self.bugs = {}
+        for bug_id in bug_ids + other_bug_ids:
+            status = rand.choice(checkbugs._status_order)
+            self.bugs[bug_id] = {
+                'id': bug_id,
+                'product': 'Beaker',
+                'status': status,
+                'resolution': rand.choice(['DUPLICATE', 'CURRENTRELEASE']) if status == 'CLOSED' else '',
+                'assigned_to': 'dev%d@redhat.com' % rand.randrange(20),
+                'target_milestone': milestone if bug_id in bug_ids else
+                        rand.choice(['---', 'future_maint', '27.3', '99.0']),
+                'cf_devel_whiteboard': 'Reverted' if rand.random() < 0.01 else '',
+            }
+
+        commit_bugs = [other_bug_ids[i // 50 % len(other_bug_ids)] if i % 50 == 0
+                       else bug_ids[i % len(bug_ids)] for i in range(commits)]
+        shas = make_repo(repo_dir, commit_bugs)
+        shas_by_bug = {}
+        for sha, bug_id in zip(shas, commit_bugs):
+            shas_by_bug.setdefault(bug_id, []).append(sha)
+
+        self.changes_by_bug = {}
+        number = 0
+        for bug_id in bug_ids:
+            for i in range(changes_per_bug):
+                number += 1
+                status = rand.choice(['MERGED', 'MERGED', 'NEW', 'ABANDONED'])
+                if status == 'MERGED' and bug_id in shas_by_bug and rand.random() < 0.98:
+                    revision = rand.choice(shas_by_bug[bug_id])
+                else:
+                    revision = '%040x' % rand.getrandbits(160)
+                change = {
+                    'project': 'beaker',
+                    'branch': 'develop',
+                    'number': str(number),
+                    'status': status,
+                    'url': 'http://gerrit.beaker-project.org/%d' % number,
+                    'owner': {'username': 'dev%d' % rand.randrange(20)},
+                    'trackingIds': [{'system': 'Bugzilla', 'id': str(bug_id)}],
+                    'currentPatchSet': {
+                        'revision': revision,
+                        'approvals': [{'type': 'Verified', 'value': str(rand.choice([-1, 0, 1]))},
+                                      {'type': 'Code-Review', 'value': str(rand.choice([-2, 1, 2]))}],
+                    },
+                }
+                self.changes_by_bug.setdefault(bug_id, []).append(change)
+
+    def call(self, service, request, live):
+        if service == 'git':
+            return live()
+        time.sleep(self.latency)
+        if service == 'bugzilla':
+            return self._query_bugs(request)
+        if service == 'gerrit':
+            return self._query_changes(*request)
+        raise ValueError(service)
+
+    def _query_bugs(self, criteria):
+        criteria = dict(criteria)
+        fields = criteria.pop('include_fields', None)
+        if 'last_change_time' in criteria:
+            # Nothing ever changes
+            return []
+        if 'bug_id' in criteria:
+            candidates = [self.bugs[bug_id] for bug_id in criteria.pop('bug_id') if bug_id in self.bugs]
+        else:
+            candidates = self.bugs.values()
+        results = []
+        for bug in candidates:
+            for field, wanted in criteria.items():
+                if bug[field] not in (wanted if isinstance(wanted, list) else [wanted]):
+                    break
+            else:
+                results.append(dict((field, value) for field, value in bug.items()
+                                    if fields is None or field in fields))
+        return results
+
+    def _query_changes(self, query, start):
+        changes = {}
+        for bug_id in re.findall(r'bug:(\d+)', query):
+            for change in self.changes_by_bug.get(int(bug_id), []):
+                changes[change['number']] = change
+        changes = sorted(changes.values(), key=lambda c: int(c['number']))
+        page = changes[start:start + GERRIT_PAGE_SIZE]
+        return page + [{'type': 'stats', 'rowCount': len(page),
+                        'moreChanges': start + len(page) < len(changes)}]
+
+
+def make_repo(repo_dir, commit_bugs):
+    """
+    Creates a git repo with one commit per entry in commit_bugs, each with a
+    Bug: footer, on top of a commit tagged beaker-28.0 which is also
+    origin/master. Returns the commit SHAs.
+    """
+    subprocess.check_call(['git', 'init', '-q', repo_dir])
+    stream = []
+    def commit(mark, message, parent=None):
+        stream.append('commit refs/heads/develop\nmark :%d\n'
+                      'committer Bench <bench@example.com> %d +0000\n' % (mark, 1500000000 + mark))
+        data = message.encode('utf8')
+        stream.append('data %d\n%s\n' % (len(data), message))
+        if parent:
+            stream.append('from :%d\n' % parent)
+    commit(1, 'Base')
+    stream.append('tag beaker-28.0\nfrom :1\ntagger Bench <bench@example.com> 1500000000 +0000\n'
+                  'data 11\nbeaker-28.0\n')
+    stream.append('reset refs/remotes/origin/master\nfrom :1\n\n')
+    for i, bug_id in enumerate(commit_bugs):
+        commit(i + 2, 'Synthetic commit %d\n\nBug: %d\n' % (i, bug_id), parent=i + 1)
+    marks_filename = os.path.join(repo_dir, '.git', 'marks')
+    subprocess.run(['git', 'fast-import', '--quiet', '--export-marks=%s' % marks_filename],
+                   cwd=repo_dir, input=''.join(stream).encode('utf8'), check=True)
+    subprocess.check_call(['git', 'checkout', '-q', 'develop'], cwd=repo_dir)
+    with open(marks_filename) as f:
+        shas = dict((int(mark[1:]), sha) for mark, sha in (line.split() for line in f))
+    return [shas[i + 2] for i in range(len(commit_bugs))]
+
+
+def run_main(backend, args):
+    """
+    Runs checkbugs.main() once, from cold, and returns its wall time and the
+    time spent in each phase (which can overlap, since main() runs them
+    concurrently).
+    """
+    module = importlib.reload(checkbugs)
+    module.use_backend(backend)
+    phase_times = dict((phase, 0.0) for phase in PHASES)
+    lock = threading.Lock()
+    def timed(phase, func):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with lock:
+                    phase_times[phase] += time.perf_counter() - start
+        return wrapper
+    for phase in PHASES:
+        setattr(module, phase, timed(phase, getattr(module, phase)))
+    sys.argv = ['checkbugs.py'] + args
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        module.main()
+    return time.perf_counter() - start, phase_times
+
+
+def main():
+    parser = ArgumentParser(description='Times checkbugs phase by phase without network access')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='Replay responses recorded with checkbugs.py --record FILE '
+                             '[default: use a synthetic milestone]')
+    parser.add_argument('-m', '--milestone', metavar='MILESTONE',
+                        help='Milestone to check [default: 29.0 for the synthetic milestone]')
+    parser.add_argument('--bugs', metavar='N', type=int, default=2000,
+                        help='Synthetic bugs in the milestone [default: %(default)s]')
+    parser.add_argument('--changes-per-bug', metavar='N', type=int, default=3,
+                        help='Synthetic Gerrit changes per bug [default: %(default)s]')
+    parser.add_argument('--commits', metavar='N', type=int, default=20000,
+                        help='Synthetic commits on the branch [default: %(default)s]')
+    parser.add_argument('--latency', metavar='SECONDS', type=float, default=0,
+                        help='Add SECONDS to each synthetic Bugzilla and Gerrit request '
+                             '[default: %(default)s]')
+    parser.add_argument('-n', '--runs', metavar='N', type=int, default=3,
+                        help='Time N runs and report the fastest [default: %(default)s]')
+    options = parser.parse_args()
+
+    repo_dir = None
+    if options.replay:
+        backend = checkbugs.FixtureBackend(options.replay, replay=True)
+        args = ['-q'] + (['-m', options.milestone] if options.milestone else [])
+    else:
+        milestone = options.milestone or '29.0'
+        repo_dir = tempfile.mkdtemp(prefix='checkbugs-benchmark-')
+        start = time.perf_counter()
+        backend = SyntheticBackend(repo_dir, milestone, bugs=options.bugs,
+                                   changes_per_bug=options.changes_per_bug,
+                                   commits=options.commits, latency=options.latency)
+        print('Generated %d bugs, %d changes and %d commits in %.1f s'
+              % (len(backend.bugs), sum(len(c) for c in backend.changes_by_bug.values()),
+                 options.commits, time.perf_counter() - start))
+        args = ['-q', '-m', milestone]
+    cwd = os.getcwd()
+    try:
+        if repo_dir:
+            os.chdir(repo_dir)
+        results = [run_main(backend, args) for _ in range(options.runs)]
+    finally:
+        os.chdir(cwd)
+        if repo_dir:
+            shutil.rmtree(repo_dir)
+
+    wall_time, phase_times = min(results, key=lambda result: result[0])
+    print('%-28s %8s' % ('Phase', 'Seconds'))
+    for phase in PHASES:
+        print('%-28s %8.3f' % (phase, phase_times[phase]))
+    print('%-28s %8.3f' % ('main() total', wall_time))
+
+if __name__ == '__main__':
+    main()
@@ -15,19 +15,27 @@ and that you have obtained a Bugzilla session cookie by executing:
 $ bugzilla login
 """
 
+import datetime
 import os
+import pickle
 import re
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 from argparse import ArgumentParser
 
 import bugzilla  # yum install python-bugzilla
+from bugzilla.bug import Bug as BugzillaBug
+import requests
 import simplejson as json
 
 BUGZILLA_URL = 'https://bugzilla.redhat.com/xmlrpc.cgi'
 GERRIT_HOSTNAME = 'gerrit.beaker-project.org'
 GERRIT_SSH_PORT = 29418
+GERRIT_URL = 'http://gerrit.beaker-project.org'
 
 
 ################################################
@@ -118,14 +126,76 @@ def bug_sort_key(bug):
     return status_key, bug.assigned_to, bug.bug_id
 
 
+# Maximum number of bug IDs to fetch from Bugzilla in a single query
+BUGZILLA_QUERY_CHUNK_SIZE = 200
+
+# Bug fields requested from Bugzilla, by default. These cover everything
+# checkbugs looks at (weburl is derived from the ID) and avoids transferring
+# the flags, CC lists and other custom fields for every bug.
+BUGZILLA_BUG_FIELDS = [
+    'id',
+    'product',
+    'status',
+    'resolution',
+    'assigned_to',
+    'target_milestone',
+    'cf_devel_whiteboard',
+]
+
+# Default location for the --cache option
+BUGZILLA_CACHE_FILENAME = os.path.expanduser('~/.cache/beaker-administrivia/checkbugs-bugzilla.pickle')
+
+
+def _bug_matches(bug, criteria):
+    for field, wanted in criteria.items():
+        if not isinstance(wanted, (list, tuple)):
+            wanted = [wanted]
+        if getattr(bug, field) not in wanted:
+            return False
+    return True
+
+
+class RecordedBug(object):
+    """
+    Stands in for a python-bugzilla Bug when queries go through a backend,
+    built from the raw API data with the attributes that checkbugs uses.
+    """
+
+    def __init__(self, url, raw_bug):
+        self._raw_bug = raw_bug
+        self.__dict__.update(raw_bug)
+        self.bug_id = raw_bug['id']
+        self.bug_status = raw_bug.get('status')
+        self.devel_whiteboard = raw_bug.get('cf_devel_whiteboard')
+        self.weburl = url.replace('xmlrpc.cgi', 'show_bug.cgi?id=%s' % self.bug_id)
+
+    def get_raw_data(self):
+        return dict(self._raw_bug)
+
+
 class BugzillaInfo(object):
 
-    def __init__(self, url=BUGZILLA_URL):
+    # When syncing the cache, go back this far before the previous sync to
+    # allow for clock skew between us and Bugzilla
+    _sync_overlap = datetime.timedelta(minutes=10)
+
+    def __init__(self, url=BUGZILLA_URL, extra_fields=()):
         self.url = url
+        self.fields = set(BUGZILLA_BUG_FIELDS) | set(extra_fields)
+        # See FixtureBackend
+        self.backend = None
         self._bz = None
         self._bz_cache = {}
+        self._cache_filename = None
+        # Queries may be run from several threads at once, this protects the
+        # proxy and the caches
+        self._lock = threading.RLock()
 
     def get_bz_proxy(self):
+        with self._lock:
+            return self._get_bz_proxy()
+
+    def _get_bz_proxy(self):
         if self._bz is None:
             self._bz = bz = bugzilla.Bugzilla(url=self.url)
             # Make sure the user has logged themselves in properly, otherwise
@@ -136,8 +206,147 @@ class BugzillaInfo(object):
                 raise RuntimeError('Not logged into Bugzilla, try running "bugzilla login"')
         return self._bz
 
-    def get_bugs(self, milestone=None, states=None, assignee=None):
+    def _include_fields(self, extra_fields):
+        """
+        Adds extra_fields to the fields requested from now on, and returns
+        the fields to request. Cached bugs which were fetched without the
+        extra fields are discarded, so that they are fetched again.
+        """
+        with self._lock:
+            if extra_fields and not self.fields.issuperset(extra_fields):
+                self.fields.update(extra_fields)
+                self._bz_cache.clear()
+            return sorted(self.fields)
+
+    def _store_bugs(self, bugs, fields):
+        # Must be called with the lock held. Bugs fetched with fewer fields
+        # than are currently wanted (because another caller asked for extra
+        # fields while the query was running) are not kept.
+        if self.fields.issubset(fields):
+            for bug in bugs:
+                self._bz_cache[bug.bug_id] = bug
+
+    def use_cache(self, filename, refresh=False):
+        """
+        Keeps Beaker bugs and the results of get_bugs() queries in filename
+        between runs. After the first run, only bugs which have changed since
+        the previous run are fetched from Bugzilla and merged into the cache.
+        If refresh is true the existing cache is ignored.
+        """
+        self._cache_filename = filename
+        self._cache_synced = False
+        self._cached_raw_bugs = {}
+        self._cached_queries = {}
+        self._synced_at = None
+        if refresh:
+            return
+        try:
+            with open(filename, 'rb') as f:
+                cache = pickle.load(f)
+        except IOError:
+            return
+        if cache['url'] != self.url:
+            return
+        # Bugs cached with fewer fields than we want now are fetched again,
+        # the query results are still valid though
+        if self.fields.issubset(cache.get('fields', ())):
+            self._cached_raw_bugs = cache['bugs']
+        self._cached_queries = cache['queries']
+        self._synced_at = cache['synced_at']
+
+    def _save_cache(self):
+        cache = {
+            'url': self.url,
+            'synced_at': self._synced_at,
+            'fields': sorted(self.fields),
+            'queries': self._cached_queries,
+            # Only Beaker bugs are kept up to date by _sync_cache()
+            'bugs': dict((bug_id, bug.get_raw_data()) for bug_id, bug in self._bz_cache.items()
+                         if bug.product == 'Beaker'),
+        }
+        os.makedirs(os.path.dirname(self._cache_filename), exist_ok=True)
+        with open(self._cache_filename + '.new', 'wb') as f:
+            pickle.dump(cache, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(self._cache_filename + '.new', self._cache_filename)
+
+    def _sync_cache(self):
+        # Called before anything is looked up, once per process
+        with self._lock:
+            self._sync_cache_locked()
+
+    def _sync_cache_locked(self):
+        if self._cache_filename is None or self._cache_synced:
+            return
+        self._cache_synced = True
+        sync_started = datetime.datetime.utcnow() - self._sync_overlap
+        if self._synced_at is not None:
+            for bug_id, raw_bug in self._cached_raw_bugs.items():
+                self._bz_cache[bug_id] = self._bug_from_raw(raw_bug)
+            self._merge_changed_bugs(self._query_changed_bugs(self._synced_at))
+        self._cached_raw_bugs = {}
+        self._synced_at = sync_started
+        self._save_cache()
+
+    def _query(self, **criteria):
+        # Every bug query goes through here, so that a backend can record or
+        # replay them
+        if self.backend is not None:
+            raw_bugs = self.backend.call('bugzilla', criteria, lambda: [
+                bug.get_raw_data() for bug in self._live_query(criteria)])
+            return [RecordedBug(self.url, raw_bug) for raw_bug in raw_bugs]
+        return self._live_query(criteria)
+
+    def _live_query(self, criteria):
         bz_proxy = self.get_bz_proxy()
+        criteria = dict(criteria)
+        last_change_time = criteria.pop('last_change_time', None)
+        query = bz_proxy.build_query(**criteria)
+        if last_change_time is not None:
+            query['last_change_time'] = last_change_time
+        return bz_proxy.query(query)
+
+    def _bug_from_raw(self, raw_bug):
+        if self.backend is not None:
+            return RecordedBug(self.url, raw_bug)
+        return BugzillaBug(self.get_bz_proxy(), dict=raw_bug)
+
+    def _query_changed_bugs(self, since):
+        return self._query(product='Beaker', include_fields=sorted(self.fields),
+                           last_change_time=since.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    def _merge_changed_bugs(self, changed_bugs):
+        # Must be called with the lock held
+        for bug in changed_bugs:
+            self._bz_cache[bug.bug_id] = bug
+        if self._cache_filename is None:
+            return
+        # A changed bug may have moved into or out of a cached query
+        for criteria, bug_ids in self._cached_queries.items():
+            for bug in changed_bugs:
+                if _bug_matches(bug, dict(criteria)):
+                    bug_ids.add(bug.bug_id)
+                else:
+                    bug_ids.discard(bug.bug_id)
+
+    def get_changed_bugs(self, since):
+        """
+        Returns the Beaker bugs which have changed since the given UTC
+        datetime, and updates the caches with them.
+        """
+        self._sync_cache()
+        since = since - self._sync_overlap
+        changed_bugs = self._query_changed_bugs(since)
+        with self._lock:
+            self._merge_changed_bugs(changed_bugs)
+            if self._cache_filename is not None:
+                # Everything up to since has been merged now
+                self._synced_at = max(self._synced_at, since)
+                self._save_cache()
+        return changed_bugs
+
+    def get_bugs(self, milestone=None, states=None, assignee=None, extra_fields=()):
+        self._sync_cache()
+        fields = self._include_fields(extra_fields)
         criteria = {'product': 'Beaker'}
         if milestone:
             criteria['target_milestone'] = milestone
@@ -145,22 +354,52 @@ class BugzillaInfo(object):
             criteria['status'] = list(states)
         if assignee:
             criteria['assigned_to'] = assignee
-        bugs = bz_proxy.query(bz_proxy.build_query(**criteria))
-        for bug in bugs:
-            self._bz_cache[bug.bug_id] = bug
+        cache_key = tuple(sorted((field, tuple(value) if isinstance(value, list) else value)
+                                 for field, value in criteria.items()))
+        with self._lock:
+            if self._cache_filename is not None and cache_key in self._cached_queries:
+                cached_bug_ids = list(self._cached_queries[cache_key])
+            else:
+                cached_bug_ids = None
+        if cached_bug_ids is not None:
+            bugs = self.get_bugs_by_id(cached_bug_ids).values()
+            return sorted(bugs, key=bug_sort_key)
+        bugs = self._query(include_fields=fields, **criteria)
+        with self._lock:
+            self._store_bugs(bugs, fields)
+            if self._cache_filename is not None:
+                self._cached_queries[cache_key] = set(bug.bug_id for bug in bugs)
+                self._save_cache()
         return sorted(bugs, key=bug_sort_key)
 
-    def get_bug(self, bug_id):
-        try:
-            return self._bz_cache[bug_id]
-        except KeyError:
-            bz_proxy = self.get_bz_proxy()
-            criteria = {'bug_id': bug_id}
-            result = bz_proxy.query(bz_proxy.build_query(**criteria))
-            if not result:
-                raise RuntimeError("No bug found with ID %r" % bug_id)
-            bug = self._bz_cache[bug_id] = result[0]
-            return bug
+    def get_bug(self, bug_id, extra_fields=()):
+        return self.get_bugs_by_id([bug_id], extra_fields)[bug_id]
+
+    def get_bugs_by_id(self, bug_ids, extra_fields=()):
+        """
+        Returns a dict of bug ID -> bug. Bugs which are not already cached are
+        fetched in batches, rather than one query per bug.
+        """
+        self._sync_cache()
+        fields = self._include_fields(extra_fields)
+        with self._lock:
+            bugs = dict((bug_id, self._bz_cache[bug_id]) for bug_id in bug_ids
+                        if bug_id in self._bz_cache)
+        missing = sorted(set(bug_ids) - set(bugs))
+        if missing:
+            fetched = []
+            for i in range(0, len(missing), BUGZILLA_QUERY_CHUNK_SIZE):
+                fetched.extend(self._query(bug_id=missing[i:i + BUGZILLA_QUERY_CHUNK_SIZE],
+                                           include_fields=fields))
+            bugs.update((bug.bug_id, bug) for bug in fetched)
+            with self._lock:
+                self._store_bugs(fetched, fields)
+                if self._cache_filename is not None:
+                    self._save_cache()
+        not_found = [bug_id for bug_id in missing if bug_id not in bugs]
+        if not_found:
+            raise RuntimeError("No bug found with ID %s" % ', '.join(str(bug_id) for bug_id in not_found))
+        return bugs
 
     def set_target_milestone(self, bug_id, target_milestone, nomail=False):
         bz_proxy = self.get_bz_proxy()
@@ -181,111 +420,519 @@ class BugzillaInfo(object):
 bz_info = BugzillaInfo()
 get_bugs = bz_info.get_bugs
 get_bug = bz_info.get_bug
+get_bugs_by_id = bz_info.get_bugs_by_id
+get_changed_bugs = bz_info.get_changed_bugs
 
 
 ################################################
 # Gerrit access
 ################################################
 
+# Bug IDs are looked up in chunks of this many per query, to keep the ssh
+# command line (and Gerrit's query) a reasonable size
+GERRIT_QUERY_CHUNK_SIZE = 50
+# Number of ssh sessions to run queries over concurrently
+GERRIT_SSH_SESSIONS = 4
+
+
 class GerritInfo(object):
 
-    def __init__(self, host=GERRIT_HOSTNAME, port=GERRIT_SSH_PORT):
+    def __init__(self, host=GERRIT_HOSTNAME, port=GERRIT_SSH_PORT, sessions=GERRIT_SSH_SESSIONS):
         self.host = host
         self.port = str(port)
+        self.sessions = sessions
+        # See FixtureBackend
+        self.backend = None
+        self._rest_url = None
+        self._rest_session = None
 
-    def get_gerrit_changes(self, bug_ids):
+    def use_rest(self, url=GERRIT_URL):
+        """
+        Queries Gerrit's REST API at url instead of running queries over ssh.
+        Connections are kept alive and shared between the concurrent queries.
+        """
+        self._rest_url = url
+        self._rest_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.sessions)
+        self._rest_session.mount('http://', adapter)
+        self._rest_session.mount('https://', adapter)
+
+    def _query(self, query, start=0):
+        """
+        Runs a single page of a Gerrit query, yielding each result object as
+        it is read from ssh or the REST API (with the stats object last).
+        """
+        if self.backend is not None:
+            return iter(self.backend.call('gerrit', [query, start],
+                                          lambda: list(self._live_query(query, start))))
+        return self._live_query(query, start)
+
+    def _live_query(self, query, start):
+        if self._rest_url is not None:
+            return self._rest_query(query, start)
+        return self._ssh_query(query, start)
+
+    def _rest_query(self, query, start):
+        # Same as _ssh_query, with the REST results converted to look like
+        # what ssh gives us
+        response = self._rest_session.get(self._rest_url + '/changes/', params=[
+            ('q', query), ('S', start), ('o', 'CURRENT_REVISION'),
+            ('o', 'DETAILED_LABELS'), ('o', 'DETAILED_ACCOUNTS'), ('o', 'TRACKING_IDS')])
+        response.raise_for_status()
+        changes = json.loads(response.text.lstrip(")]}'"))
+        for change in changes:
+            yield {
+                'number': str(change['_number']),
+                'project': change['project'],
+                'branch': change['branch'],
+                'status': change['status'],
+                'url': '%s/%d' % (self._rest_url, change['_number']),
+                'owner': {'username': change['owner'].get('username')},
+                'trackingIds': change.get('tracking_ids', []),
+                'currentPatchSet': {
+                    'revision': change['current_revision'],
+                    'approvals': [{'type': label, 'value': str(vote['value'])}
+                                  for label, label_info in change.get('labels', {}).items()
+                                  for vote in label_info.get('all', [])
+                                  if vote.get('value')],
+                },
+            }
+        yield {'type': 'stats', 'rowCount': len(changes),
+               'moreChanges': bool(changes) and changes[-1].get('_more_changes', False)}
+
+    def _ssh_query(self, query, start):
         p = subprocess.Popen(['ssh',
                               '-o', 'StrictHostKeyChecking=no',  # work around ssh bug on RHEL5
                               '-p', self.port, self.host,
                               'gerrit', 'query', '--format=json', '--current-patch-set',
-                              ' OR '.join('bug:%d' % bug_id for bug_id in bug_ids)],
+                              '--start', str(start), query],
                              stdout=subprocess.PIPE)
-        stdout, _ = p.communicate()
+        with p.stdout:
+            for line in p.stdout:
+                yield json.loads(line)
+        p.wait()
         assert p.returncode == 0, p.returncode
+
+    def _query_all_pages(self, query):
+        # Gerrit stops at its result limit and tells us in the stats object
+        # whether there were more changes, so keep going until there aren't.
+        retval = []
+        start = 0
+        while True:
+            stats = {}
+            for obj in self._query(query, start):
+                if obj.get('type') == 'stats':
+                    stats = obj
+                    continue
+                retval.append(obj)
+            if not stats.get('moreChanges') or not stats.get('rowCount'):
+                return retval
+            start += stats['rowCount']
+
+    def get_gerrit_changes(self, bug_ids, updated_within=None):
+        """
+        Returns a list of changes referring to any of the given bugs, and a
+        dict of bug ID -> list of changes referring to it (by change number).
+        If updated_within is given, only changes updated in the last that many
+        seconds are returned.
+        """
+        bug_ids = sorted(bug_ids)
+        queries = [' OR '.join('bug:%d' % bug_id
+                               for bug_id in bug_ids[i:i + GERRIT_QUERY_CHUNK_SIZE])
+                   for i in range(0, len(bug_ids), GERRIT_QUERY_CHUNK_SIZE)]
+        if updated_within is not None:
+            queries = ['(%s) NOT age:%ds' % (query, updated_within) for query in queries]
+        with ThreadPoolExecutor(max_workers=self.sessions) as executor:
+            results = list(executor.map(self._query_all_pages, queries))
+        # A change which refers to more than one bug can turn up in more
+        # than one chunk
         retval = []
-        for line in stdout.splitlines():
-            obj = json.loads(line)
-            if obj.get('type') == 'stats':
+        changes_by_bug = {}
+        seen = set()
+        for change in chain.from_iterable(results):
+            if change['number'] in seen:
                 continue
-            retval.append(obj)
-        return retval
+            seen.add(change['number'])
+            retval.append(change)
+            for bug_id in change_bug_ids(change):
+                changes_by_bug.setdefault(bug_id, []).append(change)
+        for bug_changes in changes_by_bug.values():
+            bug_changes.sort(key=lambda c: int(c['number']))
+        return retval, changes_by_bug
 
 
 # Simple module level API for the default Gerrit host
 _gerrit_info = GerritInfo()
 get_gerrit_changes = _gerrit_info.get_gerrit_changes
+use_gerrit_rest = _gerrit_info.use_rest
+
+
+def change_bug_ids(change):
+    return set(int(t['id']) for t in change['trackingIds'] if t['system'] == 'Bugzilla')
 
 
-def changes_for_bug(changes, bug_id):
-    for change in changes:
-        change_bugs = [int(t['id']) for t in change['trackingIds'] if t['system'] == 'Bugzilla']
-        if bug_id in change_bugs:
-            yield change
+def changes_for_bug(changes_by_bug, bug_id):
+    return changes_by_bug.get(bug_id, [])
+
+
+def update_changes_by_bug(changes_by_bug, changes):
+    """
+    Replaces any older copies of the given changes in changes_by_bug (as
+    returned by get_gerrit_changes()) and returns the IDs of the bugs whose
+    changes are different now.
+    """
+    updated = dict((change['number'], change) for change in changes)
+    affected_bug_ids = set()
+    for bug_id, bug_changes in changes_by_bug.items():
+        if any(change['number'] in updated for change in bug_changes):
+            affected_bug_ids.add(bug_id)
+            bug_changes[:] = [change for change in bug_changes if change['number'] not in updated]
+    for change in updated.values():
+        for bug_id in change_bug_ids(change):
+            affected_bug_ids.add(bug_id)
+            changes_by_bug.setdefault(bug_id, []).append(change)
+    for bug_id in affected_bug_ids:
+        changes_by_bug[bug_id].sort(key=lambda c: int(c['number']))
+    return affected_bug_ids
 
 
 ################################################
 # Local git query
 ################################################
 
+# Number of release branches (besides develop) checked by --all-branches
+ACTIVE_RELEASE_BRANCHES = 2
+
+# Commits are read from git this many at a time, to keep the command line a
+# reasonable size
+GIT_LOG_CHUNK_SIZE = 1000
+
+
 class GitInfo(object):
 
     def __init__(self):
-        self._revlist = None
-
-    def _git_call(self, *args):
+        self._revlists = {}
+        # See FixtureBackend
+        self.backend = None
+        # Commit -> bug IDs in its Bug: trailers, and for each rev passed to
+        # bugs_referenced_in_commits(), bug ID -> commits referring to it
+        self._commit_bugs = None
+        self._bug_commits = {}
+        self._commit_bugs_lock = threading.Lock()
+
+    def _git(self, args):
+        # Every git command goes through here, so that a backend can record or
+        # replay them. Output is kept as text in fixture files.
+        if self.backend is not None:
+            returncode, stdout, stderr = self.backend.call('git', args, lambda: [
+                (output.decode('utf8', 'surrogateescape') if isinstance(output, bytes) else output)
+                for output in self._live_git(args)])
+            return (returncode, stdout.encode('utf8', 'surrogateescape'),
+                    stderr.encode('utf8', 'surrogateescape'))
+        return self._live_git(args)
+
+    def _live_git(self, args):
         command = ['git']
         command.extend(args)
         p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         stdout, stderr = p.communicate()
-        if p.returncode != 0:
+        return p.returncode, stdout, stderr
+
+    def _git_call(self, *args):
+        returncode, stdout, stderr = self._git(args)
+        if returncode != 0:
             raise RuntimeError(f"Git call failed: {stderr.decode()}")
         return stdout
 
-    def build_git_revlist(self):
-        if self._revlist is None:
-            git_status = self._git_call('status')
-            if "branch is behind" in git_status:
-                raise RuntimeError("Git clone is not up to date")
-            self._revlist = self._git_call('rev-list', 'HEAD').splitlines()
-        return self._revlist
-
-    def git_commit_reachable(self, sha):
-        return sha in self._revlist
-
-    _bug_footer_pattern = re.compile(r'Bug:.*?(\d+)', re.I)
+    def _git_succeeds(self, *args):
+        returncode, stdout, stderr = self._git(args)
+        return returncode == 0
+
+    def _revlist_cache_filename(self, rev):
+        git_dir = self._git_call('rev-parse', '--git-dir').strip().decode()
+        if rev == 'HEAD':
+            return os.path.join(git_dir, 'checkbugs-revlist')
+        return os.path.join(git_dir, 'checkbugs-revlist-%s' % re.sub(r'[^\w.-]', '-', rev))
+
+    def _load_revlist_cache(self, rev):
+        # First line is the commit the list was built for, then all the
+        # commits reachable from it. Not used with a backend, because the
+        # git dir might not even exist when replaying.
+        if self.backend is not None:
+            return None, set()
+        try:
+            with open(self._revlist_cache_filename(rev)) as f:
+                lines = f.read().split()
+        except IOError:
+            return None, set()
+        if not lines:
+            return None, set()
+        return lines[0], set(lines[1:])
+
+    def _save_revlist_cache(self, rev, head, revlist):
+        if self.backend is not None:
+            return
+        filename = self._revlist_cache_filename(rev)
+        with open(filename + '.new', 'w') as f:
+            f.write(head + '\n')
+            f.writelines(sha + '\n' for sha in revlist)
+        os.rename(filename + '.new', filename)
+
+    def build_git_revlist(self, rev='HEAD'):
+        """
+        Returns the set of commits reachable from rev. The set is saved in the
+        git dir, so that the next time it only needs to be extended with the
+        commits added since then.
+        """
+        if rev not in self._revlists:
+            if rev == 'HEAD':
+                git_status = self._git_call('status')
+                if b"branch is behind" in git_status:
+                    raise RuntimeError("Git clone is not up to date")
+            head = self._git_call('rev-parse', rev).strip().decode()
+            cached_head, revlist = self._load_revlist_cache(rev)
+            if cached_head != head:
+                if cached_head and self._git_succeeds('merge-base', '--is-ancestor', cached_head, head):
+                    revlist.update(self._git_call('rev-list', head, '^' + cached_head).decode().split())
+                else:
+                    revlist = set(self._git_call('rev-list', head).decode().split())
+                self._save_revlist_cache(rev, head, revlist)
+            self._revlists[rev] = revlist
+        return self._revlists[rev]
+
+    def fetch(self, revs):
+        """
+        Fetches from origin and returns those of revs which have moved. Their
+        revision lists are extended the next time they are used.
+        """
+        before = dict((rev, self._git_call('rev-parse', rev).strip()) for rev in revs)
+        self._git_call('fetch', '--quiet', 'origin')
+        moved = [rev for rev in revs if self._git_call('rev-parse', rev).strip() != before[rev]]
+        for rev in moved:
+            self._revlists.pop(rev, None)
+        return moved
+
+    @staticmethod
+    def _normalize_sha(sha):
+        if isinstance(sha, bytes):
+            sha = sha.decode()
+        return sha.strip().lower()
+
+    def git_commit_reachable(self, sha, rev='HEAD'):
+        return self._normalize_sha(sha) in self.build_git_revlist(rev)
+
+    def git_commits_reachable(self, shas, rev='HEAD'):
+        """
+        Returns the subset of shas which are reachable from rev. At most one
+        git process is needed to answer all of them.
+        """
+        revlist = self.build_git_revlist(rev)
+        return set(sha for sha in shas if self._normalize_sha(sha) in revlist)
+
+    def _commit_bugs_filename(self):
+        git_dir = self._git_call('rev-parse', '--git-dir').strip().decode()
+        return os.path.join(git_dir, 'checkbugs-commit-bugs')
+
+    def _load_commit_bugs(self):
+        # One line per commit: the SHA followed by the bug IDs it refers to,
+        # if any. Not used with a backend, same as the revlist cache.
+        commit_bugs = {}
+        if self.backend is not None:
+            return commit_bugs
+        try:
+            with open(self._commit_bugs_filename()) as f:
+                for line in f:
+                    fields = line.split()
+                    if fields:
+                        commit_bugs[fields[0]] = [int(bug_id) for bug_id in fields[1:]]
+        except IOError:
+            pass
+        return commit_bugs
+
+    def _save_commit_bugs(self):
+        if self.backend is not None:
+            return
+        filename = self._commit_bugs_filename()
+        with open(filename + '.new', 'w') as f:
+            for sha, bug_ids in self._commit_bugs.items():
+                f.write(' '.join([sha] + [str(bug_id) for bug_id in bug_ids]) + '\n')
+        os.rename(filename + '.new', filename)
+
+    _bug_id_pattern = re.compile(r'\d+')
+
+    def _read_commit_bugs(self, *args):
+        # Must be called with the lock held
+        output = self._git_call('log', '--format=%x00%H%x00%(trailers:key=Bug,valueonly)',
+                                *args).decode()
+        fields = output.split('\0')[1:]
+        for sha, trailers in zip(fields[0::2], fields[1::2]):
+            bug_ids = []
+            for value in trailers.splitlines():
+                m = self._bug_id_pattern.search(value)
+                if m:
+                    bug_ids.append(int(m.group()))
+            self._commit_bugs[sha] = bug_ids
+
+    def commit_bug_ids(self, shas, rev_range=None):
+        """
+        Returns a dict of commit -> list of bug IDs in its Bug: trailers. The
+        answers are kept in an index in the git dir, so only the trailers of
+        commits which have not been seen before are read from git. If the
+        commits are rev_range and most of them are new, the whole range is
+        read at once, which is cheaper than naming each commit.
+        """
+        with self._commit_bugs_lock:
+            if self._commit_bugs is None:
+                self._commit_bugs = self._load_commit_bugs()
+            missing = [sha for sha in shas if sha not in self._commit_bugs]
+            if rev_range is not None and len(missing) > GIT_LOG_CHUNK_SIZE:
+                self._read_commit_bugs(rev_range)
+            else:
+                for i in range(0, len(missing), GIT_LOG_CHUNK_SIZE):
+                    self._read_commit_bugs('--no-walk=unsorted', *missing[i:i + GIT_LOG_CHUNK_SIZE])
+            if missing:
+                self._save_commit_bugs()
+            return dict((sha, self._commit_bugs[sha]) for sha in shas)
 
-    def bugs_referenced_in_commits(self):
+    def bugs_referenced_in_commits(self, rev='HEAD'):
         """
-        Returns a list of bug IDs mentioned in all commits from master to HEAD.
+        Returns a list of bug IDs mentioned in all commits from master to rev.
         """
-        messages = self._git_call('log', '--pretty=%B', 'origin/master..HEAD')
+        rev_range = 'origin/master..%s' % rev
+        shas = self._git_call('rev-list', rev_range).decode().split()
+        commit_bugs = self.commit_bug_ids(shas, rev_range)
         bug_ids = []
-        for line in messages.splitlines():
-            m = self._bug_footer_pattern.search(line)
-            if m:
-                bug_ids.append(int(m.group(1)))
+        bug_commits = {}
+        for sha in shas:
+            for bug_id in commit_bugs[sha]:
+                bug_ids.append(bug_id)
+                bug_commits.setdefault(bug_id, []).append(sha)
+        self._bug_commits[rev] = bug_commits
         return bug_ids
 
+    def commits_referencing_bug(self, bug_id, rev='HEAD'):
+        """
+        Returns the commits from master to rev which mention the given bug,
+        newest first.
+        """
+        if rev not in self._bug_commits:
+            self.bugs_referenced_in_commits(rev)
+        return self._bug_commits[rev].get(bug_id, [])
+
     def current_git_branch(self):
         remote_ref_name = self._git_call('name-rev', '--refs=refs/remotes/origin/*', '--name-only',
-                                         'HEAD').strip()
+                                         'HEAD').strip().decode()
         # Output will be either 'remotes/origin/release-22' or
         # 'origin/release-22' depending on git version...
-        return remote_ref_name.split(b'/')[-1]
+        return remote_ref_name.split('/')[-1]
+
+    def upstream_branch(self):
+        # Remote tracking ref for the current checkout, like origin/develop
+        return self._git_call('rev-parse', '--abbrev-ref', '--symbolic-full-name',
+                              '@{upstream}').strip().decode()
 
-    def current_version(self):
-        tag = self._git_call('describe', '--abbrev=0', 'HEAD').strip()
+    def current_version(self, rev='HEAD'):
+        tag = self._git_call('describe', '--abbrev=0', rev).strip().decode()
         assert tag.startswith('beaker-')
         return tag[len('beaker-'):]
 
+    def active_branches(self, release_branches=ACTIVE_RELEASE_BRANCHES):
+        """
+        Returns the remote tracking refs for develop and the newest
+        release branches, read from refs so nothing needs to be checked out.
+        """
+        refs = self._git_call('for-each-ref', '--format=%(refname:short)',
+                              'refs/remotes/origin/').decode().split()
+        releases = []
+        for ref in refs:
+            m = re.match(r'origin/release-(\d+)$', ref)
+            if m:
+                releases.append((int(m.group(1)), ref))
+        releases.sort(reverse=True)
+        branches = [ref for _, ref in releases[:release_branches]]
+        if 'origin/develop' in refs:
+            branches.insert(0, 'origin/develop')
+        return branches
+
 
 # Simple module level API for a git repo in the current working dir
 _git_info = GitInfo()
 git_commit_reachable = _git_info.git_commit_reachable
+git_commits_reachable = _git_info.git_commits_reachable
 build_git_revlist = _git_info.build_git_revlist
 bugs_referenced_in_commits = _git_info.bugs_referenced_in_commits
+commits_referencing_bug = _git_info.commits_referencing_bug
 current_git_branch = _git_info.current_git_branch
 current_version = _git_info.current_version
+active_branches = _git_info.active_branches
+upstream_branch = _git_info.upstream_branch
+git_fetch = _git_info.fetch
+
+
+################################################
+# Recording and replaying responses
+################################################
+
+class FixtureBackend(object):
+    """
+    Backend for BugzillaInfo, GerritInfo and GitInfo which records the
+    responses they get to a JSON fixture file, or replays them from one. That
+    lets checkbugs be run (and timed) without the network or the git repo.
+
+    Any object with the same call() method can be used as a backend, for
+    example to answer queries from synthetic data.
+    """
+
+    def __init__(self, filename, replay=False):
+        self.filename = filename
+        self.replay = replay
+        self._lock = threading.Lock()
+        if replay:
+            with open(filename) as f:
+                self._responses = json.load(f)
+            self._recorded_bugs = dict((raw_bug['id'], raw_bug) for raw_bugs
+                                       in self._responses.get('bugzilla', {}).values()
+                                       for raw_bug in raw_bugs)
+        else:
+            self._responses = {}
+
+    def call(self, service, request, live):
+        """
+        Returns the response from service (bugzilla, gerrit or git) to
+        request, calling live() for it unless we are replaying.
+        """
+        key = json.dumps(request, sort_keys=True)
+        if self.replay:
+            if service == 'bugzilla' and 'bug_id' in request:
+                # Which IDs are asked for depends on what was already cached,
+                # which depends on thread timing, so these are answered from
+                # every bug that was recorded
+                return [self._recorded_bugs[bug_id] for bug_id in request['bug_id']
+                        if bug_id in self._recorded_bugs]
+            try:
+                return self._responses[service][key]
+            except KeyError:
+                raise RuntimeError('No recorded %s response for %s' % (service, key))
+        response = live()
+        with self._lock:
+            self._responses.setdefault(service, {})[key] = response
+        return response
+
+    def save(self):
+        if self.replay:
+            return
+        with self._lock:
+            with open(self.filename + '.new', 'w') as f:
+                # Extra Bugzilla fields may hold dates, which are kept as
+                # strings
+                json.dump(self._responses, f, sort_keys=True, indent=1, default=str)
+            os.rename(self.filename + '.new', self.filename)
+
+
+def use_backend(backend):
+    bz_info.backend = backend
+    _gerrit_info.backend = backend
+    _git_info.backend = backend
 
 
 ################################################
@@ -300,17 +947,26 @@ current_version = _git_info.current_version
 # Milestone tracking
 #  - filters based on the target milestone in Bugzilla
 
-def get_default_milestone():
-    # Figure out what milestone we are interested based on the version
-    # currently checked out.
+def milestone_for_branch(branch, version):
     # If we are on a release branch, we are working on x.y+1 (for example,
     # release-22 branch with version 22.3 means we are interested in 22.4).
     # For all other branches, including develop, we are working on x+1.0 (for
     # example, develop branch with version 22.3 means we are interested in
     # 23.0).
-    if current_git_branch().startswith(b'release-'):
-        return next_maintenance(current_version())
-    return next_develop(current_version())
+    if branch.startswith('release-'):
+        return next_maintenance(version)
+    return next_develop(version)
+
+
+def get_default_milestone():
+    # Figure out what milestone we are interested based on the version
+    # currently checked out.
+    return milestone_for_branch(current_git_branch(), current_version())
+
+
+def get_branch_milestone(rev):
+    # Same as above, for a branch which need not be checked out
+    return milestone_for_branch(rev.split('/')[-1], current_version(rev))
 
 
 # These are the names of long-lived feature branches which are abandoned and/or
@@ -324,6 +980,244 @@ ABANDONED_FEATURE_BRANCHES = [
     'results-reporting-improvements-take2',
 ]
 
+# In progress bugs should always have a milestone
+IN_WORK_STATES = [
+    'MODIFIED',
+    'ON_QA',
+    'VERIFIED',
+    'RELEASE_PENDING',
+]
+
+
+def change_approval(change, approval_type):
+    # Highest score of the given type on the current patch set, or 0
+    return max((int(a['value']) for a in change['currentPatchSet'].get('approvals', [])
+                if a['type'] == approval_type), default=0)
+
+
+def print_bug_summary(bug, bug_changes):
+    print('Bug %-13d %-17s %-10s <%s>' % (bug.bug_id, bug.bug_status,
+                                          abbrev_user(bug.assigned_to), bug.weburl))
+    for change in bug_changes:
+        verified = change_approval(change, 'Verified')
+        reviewed = change_approval(change, 'Code-Review')
+        print('    Change %-6s %-17s %-10s <%s>' % (change['number'],
+                                                    '%s (%d/%d)' % (
+                                                        change['status'], verified,
+                                                        reviewed),
+                                                    change['owner']['username'],
+                                                    change['url']))
+
+
+def check_bug(bug, bug_changes, rev='HEAD'):
+    """
+    Returns a list of problems with the state of the bug, given the Gerrit
+    changes for it and the branch its milestone is being worked on in.
+    """
+    problems = []
+
+    # check for patch state inconsistencies
+    unabandoned_bug_changes = [change for change in bug_changes
+                               if change['status'] != 'ABANDONED']
+    if not unabandoned_bug_changes:
+        # No patches exist, or they're all abandoned.
+        # We accept closed states here because the bug might have been
+        # fixed by something other than a Beaker patch (like a beah patch, etc).
+        acceptable_bug_states = ['NEW', 'ASSIGNED', 'ON_QA', 'VERIFIED', 'CLOSED']
+    elif any(change['status'] != 'MERGED' for change in unabandoned_bug_changes):
+        # Some patches are undergoing review.
+        acceptable_bug_states = ['ASSIGNED', 'POST']
+    else:
+        # Patches exist and they are all merged.
+        if 'Reverted' in bug.devel_whiteboard.split():
+            acceptable_bug_states = ['ASSIGNED']
+        else:
+            acceptable_bug_states = ['MODIFIED', 'ON_QA', 'VERIFIED', 'CLOSED']
+    if bug.bug_status not in acceptable_bug_states:
+        problems.append('Bug %s should be %s, not %s'
+                        % (bug.bug_id, ' or '.join(acceptable_bug_states), bug.bug_status))
+
+    if bug.bug_status == 'CLOSED' and bug.resolution == 'DUPLICATE':
+        # beaker_dupe_clear Bugzilla rule actually does this for us
+        problems.append('Bug %s should have no milestone since it is marked DUPLICATE' % bug.bug_id)
+
+    # Check merge consistency
+    merged_shas = [change['currentPatchSet']['revision'] for change in bug_changes
+                   if change['status'] == 'MERGED' and change['project'] == 'beaker'
+                   and change['branch'] not in ABANDONED_FEATURE_BRANCHES]
+    reachable_shas = git_commits_reachable(merged_shas, rev)
+    for sha in merged_shas:
+        if sha not in reachable_shas:
+            problems.append('Bug %s: Commit %s is not reachable from %s '
+                            ' (is this clone up to date?)' % (bug.bug_id, sha, rev))
+
+    return problems
+
+
+def check_referenced_bugs(referenced_bug_ids, bug_ids, milestone, rev='HEAD'):
+    """
+    Returns a list of problems with bugs referenced by commits on a branch
+    which are not slated for the branch's milestone.
+    """
+    problems = []
+    referenced_bugs = get_bugs_by_id(set(referenced_bug_ids) - bug_ids)
+    seen = set()
+    for referenced_bug_id in referenced_bug_ids:
+        # Bugs referenced by more than one commit are only reported once
+        if referenced_bug_id in seen:
+            continue
+        seen.add(referenced_bug_id)
+        if referenced_bug_id not in bug_ids:
+            referenced_bug = referenced_bugs[referenced_bug_id]
+            # If the bug had a patch merged, but then reverted, we can put
+            # "Reverted" into the devel whiteboard to keep checkbugs from
+            # getting upset about it.
+            if 'Reverted' in referenced_bug.devel_whiteboard.split():
+                continue
+            # We have found a patch referencing a bug which is not in our
+            # milestone. It could be a merge/cherry-pick of a bug which is
+            # already fixed in some release, or on the maintenance branch:
+            # those are not a problem.
+            # Only raise the alarm if the referenced bug's milestone is
+            # newer or not set.
+            if (referenced_bug.target_milestone == '---' or
+                    referenced_bug.target_milestone == 'future_maint' or
+                    vercmp(referenced_bug.target_milestone, milestone) > 0):
+                problems.append('Bug %s is referenced by commit %s on this branch '
+                                'but target milestone is %s'
+                                % (referenced_bug.bug_id,
+                                   ', '.join(commits_referencing_bug(referenced_bug_id, rev)),
+                                   referenced_bug.target_milestone))
+    return problems
+
+
+def check_in_work_bugs(in_work_bugs):
+    """
+    Returns a list of problems for bugs which are being worked on but have no
+    milestone.
+    """
+    return ['Bug %s status is %s but target milestone is not set' %
+            (no_milestone.bug_id, no_milestone.bug_status)
+            for no_milestone in in_work_bugs]
+
+
+# Default number of seconds between polls for --watch
+WATCH_INTERVAL = 300
+
+
+def watch(options, branches, bugs, changes_by_bug, referenced_bug_ids_by_rev, in_work_bugs, since):
+    """
+    Polls Bugzilla, Gerrit and the origin remote for anything which has
+    changed since the last poll, runs the checks again for the bugs and
+    branches affected by it, and reports problems which have appeared or been
+    resolved. Runs until interrupted.
+    """
+    criteria = {'product': 'Beaker', 'target_milestone': [milestone for _, milestone in branches]}
+    if options.include:
+        criteria['status'] = options.include
+    in_work_criteria = {'product': 'Beaker', 'target_milestone': ['---', 'future_maint'],
+                        'status': IN_WORK_STATES}
+    bugs_by_id = dict((bug.bug_id, bug) for bug in bugs)
+    in_work_bugs_by_id = dict((bug.bug_id, bug) for bug in in_work_bugs)
+    prefixes = dict((rev, '%s: ' % rev if options.all_branches else '') for rev, _ in branches)
+
+    def bug_problems(rev, milestone, bug_id):
+        bug = bugs_by_id.get(bug_id)
+        if bug is None or bug.target_milestone != milestone:
+            return []
+        return [prefixes[rev] + message for message in
+                check_bug(bug, changes_for_bug(changes_by_bug, bug_id), rev)]
+
+    def referenced_problems(rev, milestone):
+        if options.include:
+            return []
+        bug_ids = set(bug_id for bug_id, bug in bugs_by_id.items()
+                      if bug.target_milestone == milestone)
+        return [prefixes[rev] + message for message in
+                check_referenced_bugs(referenced_bug_ids_by_rev[rev], bug_ids, milestone, rev)]
+
+    def in_work_problems():
+        if options.include:
+            return []
+        return check_in_work_bugs(sorted(in_work_bugs_by_id.values(), key=bug_sort_key))
+
+    # Problems are kept by the check which found them, so that only the
+    # checks affected by a change need to be run again
+    problems = {}
+    for rev, milestone in branches:
+        for bug_id in bugs_by_id:
+            problems[rev, bug_id] = bug_problems(rev, milestone, bug_id)
+        problems[rev, 'references'] = referenced_problems(rev, milestone)
+    problems['in work'] = in_work_problems()
+
+    try:
+        while True:
+            time.sleep(options.watch)
+            poll_started = datetime.datetime.utcnow()
+
+            changed_bugs = get_changed_bugs(since)
+            affected_bug_ids = set(bug.bug_id for bug in changed_bugs)
+            new_bug_ids = set()
+            for bug in changed_bugs:
+                if _bug_matches(bug, criteria):
+                    if bug.bug_id not in bugs_by_id:
+                        new_bug_ids.add(bug.bug_id)
+                    bugs_by_id[bug.bug_id] = bug
+                else:
+                    bugs_by_id.pop(bug.bug_id, None)
+                if _bug_matches(bug, in_work_criteria):
+                    in_work_bugs_by_id[bug.bug_id] = bug
+                else:
+                    in_work_bugs_by_id.pop(bug.bug_id, None)
+
+            # Bugs which have just turned up need all of their changes,
+            # otherwise only changes updated since the last poll are fetched
+            # (with a little slack for the time the Bugzilla query took)
+            changes = []
+            if new_bug_ids:
+                changes.extend(get_gerrit_changes(new_bug_ids)[0])
+            if bugs_by_id:
+                updated_within = int((datetime.datetime.utcnow() - since).total_seconds()) + 60
+                changes.extend(get_gerrit_changes(bugs_by_id, updated_within=updated_within)[0])
+            affected_bug_ids.update(update_changes_by_bug(changes_by_bug, changes))
+
+            moved_revs = git_fetch([rev for rev, _ in branches])
+            if not options.include:
+                for rev in moved_revs:
+                    referenced_bug_ids_by_rev[rev] = bugs_referenced_in_commits(rev)
+
+            if options.verbose:
+                print("%s: %d bugs, %d patch reviews and %d branches changed"
+                      % (poll_started.strftime('%H:%M:%S'), len(changed_bugs), len(changes),
+                         len(moved_revs)))
+
+            updated = {}
+            for rev, milestone in branches:
+                if rev in moved_revs:
+                    # Any merged change could be reachable now
+                    bug_ids = set(bugs_by_id) | affected_bug_ids
+                else:
+                    bug_ids = affected_bug_ids
+                for bug_id in bug_ids:
+                    updated[rev, bug_id] = bug_problems(rev, milestone, bug_id)
+                if changed_bugs or rev in moved_revs:
+                    updated[rev, 'references'] = referenced_problems(rev, milestone)
+            if changed_bugs:
+                updated['in work'] = in_work_problems()
+            for key, messages in updated.items():
+                old_messages = problems.pop(key, [])
+                for message in messages:
+                    if message not in old_messages:
+                        problem(message)
+                for message in old_messages:
+                    if message not in messages:
+                        print('Resolved: %s' % message)
+                if messages:
+                    problems[key] = messages
+            since = poll_started
+    except KeyboardInterrupt:
+        pass
+
 
 def main():
     parser = ArgumentParser('usage: %prog [options]',
@@ -331,138 +1225,166 @@ def main():
     parser.add_argument('-m', '--milestone', metavar='MILESTONE',
                         help='Check bugs slated for MILESTONE '
                              '[default: guess from current checkout]')
+    parser.add_argument('--all-branches', action='store_true',
+                        help='Check develop and the %d newest release branches, each '
+                             'against its own milestone, instead of the current '
+                             'checkout' % ACTIVE_RELEASE_BRANCHES)
     parser.add_argument('-i', '--include', metavar='STATE', action="append",
                         help='Include bugs in the specified state '
                              '(may be given multiple times)')
     parser.add_argument('-q', '--quiet', action="store_false",
                         dest="verbose", default=True,
                         help='Only display problem reports')
+    parser.add_argument('--cache', metavar='FILE', nargs='?', const=BUGZILLA_CACHE_FILENAME,
+                        help='Keep Bugzilla bugs in FILE between runs and only fetch '
+                             'changed bugs [default FILE: %s]' % BUGZILLA_CACHE_FILENAME)
+    parser.add_argument('--refresh', action='store_true',
+                        help='Ignore the existing cache and fetch all bugs again')
+    parser.add_argument('--gerrit-rest', action='store_true',
+                        help='Query Gerrit over its REST API instead of ssh')
+    parser.add_argument('--record', metavar='FILE',
+                        help='Record all Bugzilla, Gerrit and git responses to FILE')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='Replay responses recorded with --record instead of '
+                             'querying Bugzilla, Gerrit and git')
+    parser.add_argument('--watch', metavar='SECONDS', type=int, nargs='?', const=WATCH_INTERVAL,
+                        help='Keep running, and every SECONDS report problems which have '
+                             'appeared or been resolved since the last check. The '
+                             'current checkout\'s upstream branch is checked, after '
+                             'fetching from origin [default SECONDS: %d]' % WATCH_INTERVAL)
     options = parser.parse_args()
+    if options.all_branches and options.milestone:
+        parser.error('--milestone cannot be used with --all-branches')
+    if options.replay and (options.record or options.cache or options.watch):
+        parser.error('--replay cannot be used with --record, --cache or --watch')
     print(options)
-    if not options.milestone:
-        options.milestone = get_default_milestone()
-        print("Using milestone %s" % options.milestone)
-
-    if options.verbose:
-        print("Building git revision list for HEAD")
-    build_git_revlist()
-    if options.verbose:
-        print("Retrieving bug list from Bugzilla")
-    bugs = get_bugs(milestone=options.milestone, states=options.include)
-    bug_ids = set(bug.bug_id for bug in bugs)
-    if options.verbose:
-        print("  Retrieved %d bugs" % len(bugs))
-    if not bug_ids:
-        print("No bugs to check. Bye Bye")
-        return
-
-    if options.verbose:
-        print("Retrieving code review details from Gerrit")
-    changes = get_gerrit_changes(bug_ids)
-    if options.verbose:
-        print("  Retrieved %d patch reviews" % len(changes))
-
-    # Consistency check on all bugs in the specified milestone
-    for bug in bugs:
+    if options.gerrit_rest:
+        use_gerrit_rest()
+    if options.record:
+        backend = FixtureBackend(options.record)
+        use_backend(backend)
+    if options.replay:
+        use_backend(FixtureBackend(options.replay, replay=True))
+    if options.cache:
+        bz_info.use_cache(options.cache, refresh=options.refresh)
+
+    # Each branch is checked against its own milestone and reachability set,
+    # but the bugs and changes for all of them are fetched together
+    if options.all_branches:
+        branches = [(rev, get_branch_milestone(rev)) for rev in active_branches()]
+        for rev, milestone in branches:
+            print("Using milestone %s for %s" % (milestone, rev))
+    else:
+        if not options.milestone:
+            options.milestone = get_default_milestone()
+            print("Using milestone %s" % options.milestone)
+        # When watching, new commits are fetched into the upstream branch
+        # rather than the checkout
+        branches = [(upstream_branch() if options.watch else 'HEAD', options.milestone)]
+    milestones = [milestone for _, milestone in branches]
+
+    # Git, Bugzilla and Gerrit are all queried at once in the background.
+    # Results are still reported in the same order as they used to be.
+    started = datetime.datetime.utcnow()
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        revlist_futures = [executor.submit(build_git_revlist, rev) for rev, _ in branches]
+        bugs_future = executor.submit(get_bugs, milestone=milestones,
+                                      states=options.include)
+
+        def get_changes_for_bugs():
+            bug_ids = set(bug.bug_id for bug in bugs_future.result())
+            if not bug_ids:
+                return [], {}
+            return get_gerrit_changes(bug_ids)
+        changes_future = executor.submit(get_changes_for_bugs)
+
+        if not options.include:
+            referenced_bug_ids_futures = [executor.submit(bugs_referenced_in_commits, rev)
+                                          for rev, _ in branches]
+
+            def prefetch_referenced_bugs():
+                bug_ids = set(bug.bug_id for bug in bugs_future.result())
+                # Fetch all the referenced bugs up front, in as few queries as possible
+                get_bugs_by_id(set(chain.from_iterable(f.result() for f in referenced_bug_ids_futures))
+                               - bug_ids)
+            referenced_bugs_future = executor.submit(prefetch_referenced_bugs)
+            in_work_bugs_future = executor.submit(get_bugs, milestone=['---', 'future_maint'],
+                                                  states=IN_WORK_STATES)
+
+        for (rev, _), revlist_future in zip(branches, revlist_futures):
+            if options.verbose:
+                print("Building git revision list for %s" % rev)
+            revlist_future.result()
+        if options.verbose:
+            print("Retrieving bug list from Bugzilla")
+        bugs = bugs_future.result()
+        if options.verbose:
+            print("  Retrieved %d bugs" % len(bugs))
+        if not bugs and not options.watch:
+            print("No bugs to check. Bye Bye")
+            if options.record:
+                backend.save()
+            return
+
         if options.verbose:
-            print('Bug %-13d %-17s %-10s <%s>' % (bug.bug_id, bug.bug_status,
-                                                  abbrev_user(bug.assigned_to), bug.weburl))
-        bug_changes = list(changes_for_bug(changes, bug.bug_id))
-
-        # print out summary of changes
-        for change in sorted(bug_changes, key=lambda c: int(c['number'])):
-            patch_set = change['currentPatchSet']
-            verified = max(chain([None], (int(a['value'])
-                                          for a in patch_set.get('approvals', []) if
-                                          a['type'] == 'Verified'))) or 0
-            reviewed = max(chain([None], (int(a['value'])
-                                          for a in patch_set.get('approvals', []) if
-                                          a['type'] == 'Code-Review'))) or 0
+            print("Retrieving code review details from Gerrit")
+        changes, changes_by_bug = changes_future.result()
+        if options.verbose:
+            print("  Retrieved %d patch reviews" % len(changes))
+
+    for i, (rev, milestone) in enumerate(branches):
+        if options.all_branches:
             if options.verbose:
-                print('    Change %-6s %-17s %-10s <%s>' % (change['number'],
-                                                            '%s (%d/%d)' % (
-                                                                change['status'], verified,
-                                                                reviewed),
-                                                            change['owner']['username'],
-                                                            change['url']))
-
-        # check for patch state inconsistencies
-        unabandoned_bug_changes = [change for change in bug_changes
-                                   if change['status'] != 'ABANDONED']
-        if not unabandoned_bug_changes:
-            # No patches exist, or they're all abandoned.
-            # We accept closed states here because the bug might have been
-            # fixed by something other than a Beaker patch (like a beah patch, etc).
-            acceptable_bug_states = ['NEW', 'ASSIGNED', 'ON_QA', 'VERIFIED', 'CLOSED']
-        elif any(change['status'] != 'MERGED' for change in unabandoned_bug_changes):
-            # Some patches are undergoing review.
-            acceptable_bug_states = ['ASSIGNED', 'POST']
+                print("Checking %s for milestone %s\n" % (rev, milestone))
+            prefix = '%s: ' % rev
         else:
-            # Patches exist and they are all merged.
-            if 'Reverted' in bug.devel_whiteboard.split():
-                acceptable_bug_states = ['ASSIGNED']
-            else:
-                acceptable_bug_states = ['MODIFIED', 'ON_QA', 'VERIFIED', 'CLOSED']
-        if bug.bug_status not in acceptable_bug_states:
-            problem('Bug %s should be %s, not %s'
-                    % (bug.bug_id, ' or '.join(acceptable_bug_states), bug.bug_status))
-
-        if bug.bug_status == 'CLOSED' and bug.resolution == 'DUPLICATE':
-            # beaker_dupe_clear Bugzilla rule actually does this for us
-            problem('Bug %s should have no milestone since it is marked DUPLICATE' % bug.bug_id)
-
-        # Check merge consistency
-        for change in bug_changes:
-            if change['status'] == 'MERGED' and change['project'] == 'beaker' and \
-                    change['branch'] not in ABANDONED_FEATURE_BRANCHES:
-                sha = change['currentPatchSet']['revision']
-                if not git_commit_reachable(sha):
-                    problem('Bug %s: Commit %s is not reachable from HEAD '
-                            ' (is this clone up to date?)' % (bug.bug_id, sha))
+            prefix = ''
+        branch_bugs = [bug for bug in bugs if bug.target_milestone == milestone]
+        bug_ids = set(bug.bug_id for bug in branch_bugs)
 
-        if options.verbose:
-            print('\n')
+        # Consistency check on all bugs in the specified milestone
+        for bug in branch_bugs:
+            bug_changes = changes_for_bug(changes_by_bug, bug.bug_id)
+            if options.verbose:
+                print_bug_summary(bug, bug_changes)
+            for message in check_bug(bug, bug_changes, rev):
+                problem(prefix + message)
+            if options.verbose:
+                print('\n')
 
-    # Check for commits which reference a bug not in this milestone
-    if not options.include:
-        if options.verbose:
-            print("Checking commit bug references for consistency")
-        for referenced_bug_id in bugs_referenced_in_commits():
-            if referenced_bug_id not in bug_ids:
-                referenced_bug = get_bug(referenced_bug_id)
-                # If the bug had a patch merged, but then reverted, we can put
-                # "Reverted" into the devel whiteboard to keep checkbugs from
-                # getting upset about it.
-                if 'Reverted' in referenced_bug.devel_whiteboard.split():
-                    continue
-                # We have found a patch referencing a bug which is not in our
-                # milestone. It could be a merge/cherry-pick of a bug which is
-                # already fixed in some release, or on the maintenance branch:
-                # those are not a problem.
-                # Only raise the alarm if the referenced bug's milestone is
-                # newer or not set.
-                if (referenced_bug.target_milestone == '---' or
-                        referenced_bug.target_milestone == 'future_maint' or
-                        vercmp(referenced_bug.target_milestone, options.milestone) > 0):
-                    problem('Bug %s is referenced by a commit on this branch '
-                            'but target milestone is %s'
-                            % (referenced_bug.bug_id, referenced_bug.target_milestone))
+        # Check for commits which reference a bug not in this milestone
+        if not options.include:
+            if options.verbose:
+                print("Checking commit bug references for consistency")
+            referenced_bug_ids = referenced_bug_ids_futures[i].result()
+            referenced_bugs_future.result()
+            for message in check_referenced_bugs(referenced_bug_ids, bug_ids, milestone, rev):
+                problem(prefix + message)
 
     # Check for bugs with a missing milestone setting
     if not options.include:
         if options.verbose:
             print("Checking milestone and bug status consistency")
-        # In progress bugs should always have a milestone
-        _in_work_states = [
-            'MODIFIED',
-            'ON_QA',
-            'VERIFIED',
-            'RELEASE_PENDING',
-        ]
-        in_work_bugs = get_bugs(milestone=['---', 'future_maint'], states=_in_work_states)
-        for no_milestone in in_work_bugs:
-            problem('Bug %s status is %s but target milestone is not set' %
-                    (no_milestone.bug_id, no_milestone.bug_status))
+        for message in check_in_work_bugs(in_work_bugs_future.result()):
+            problem(message)
+
+    if options.record:
+        backend.save()
+
+    if options.watch:
+        if options.include:
+            referenced_bug_ids_by_rev = {}
+            in_work_bugs = []
+        else:
+            referenced_bug_ids_by_rev = dict((rev, future.result()) for (rev, _), future
+                                             in zip(branches, referenced_bug_ids_futures))
+            in_work_bugs = in_work_bugs_future.result()
+        if options.verbose:
+            print("Watching for changes every %d seconds" % options.watch)
+        watch(options, branches, bugs, changes_by_bug, referenced_bug_ids_by_rev,
+              in_work_bugs, started)
+        if options.record:
+            backend.save()
 
 
 if __name__ == '__main__':
@@ -2,51 +2,215 @@
 
 import sys
 import os
-from glob import glob
+from argparse import ArgumentParser
+import hashlib
 import math
 from collections import namedtuple, Counter
 import datetime
 import json
 import re
+import sqlite3
 import lxml.etree
 
-def dogfood_job_dirs():
-    el6dir = '/srv/www/jenkins-results/beaker-review-checks-dogfood-RedHatEnterpriseLinux6'
-    for jobnum in os.listdir(el6dir):
-        yield os.path.join(el6dir, jobnum)
-    el7dir = '/srv/www/jenkins-results/beaker-review-checks-dogfood-RedHatEnterpriseLinux7'
-    for jobnum in os.listdir(el7dir):
-        if int(jobnum) < 49:
-            continue # builds before #49 were busted
-        yield os.path.join(el7dir, jobnum)
+from dogfoodjobs import dogfood_jobs
+
+# Known issue match results for each log are kept here between runs
+CACHE_FILENAME = os.path.expanduser('~/.cache/beaker-administrivia/dogfood-known-issues.sqlite')
+
+def nose_failures(output):
+    """
+    Splits nose output into the blocks describing each failed test.
+    """
+    return re.split(rb'={70}\n|-{70}\nRan ', output)[1:-1]
+
+# Serial console output is full of terminal escape sequences, and characters
+# are often split up by whitespace or other control codes.
+_console_escape_pattern = re.compile(rb'\x1b\[[0-?]*[ -/]*[@-~]|\x1b[@-_]')
+_console_control_bytes = bytes(range(0x21)) + b'\x7f'
+# Equivalent to removing escapes and then control bytes, in a single pass
+_console_noise_pattern = re.compile(rb'\x1b\[[0-?]*[ -/]*[@-~]|\x1b[@-_]|[\x00-\x1a\x1c-\x20\x7f]+|\x1b')
+
+def normalize_console(output):
+    """
+    Strips escape sequences, control codes and whitespace from console
+    output, so that patterns can be matched against it without allowing for
+    noise between every character.
+    """
+    if b'\x1b' in output:
+        output = _console_escape_pattern.sub(b'', output)
+    return output.translate(None, _console_control_bytes)
+
+def console_offset(output, normalized_offset):
+    """
+    Maps an offset in normalize_console(output) back to the corresponding
+    offset in the original output, for reporting where a match was found.
+    """
+    kept = 0
+    pos = 0
+    for noise in _console_noise_pattern.finditer(output):
+        if kept + (noise.start() - pos) > normalized_offset:
+            break
+        kept += noise.start() - pos
+        pos = noise.end()
+    return pos + (normalized_offset - kept)
+
+def _normalized_tail_offset(output, span):
+    """
+    Returns the offset in output where the last span bytes of
+    normalize_console(output) came from, without mapping all of output.
+    """
+    end = len(output)
+    while True:
+        # No escape sequence spans a newline, so normalizing from just after
+        # one gives the tail of normalizing the whole thing.
+        start = output.rfind(b'\n', 0, max(end - span, 0)) + 1
+        tail = normalize_console(output[start:])
+        if len(tail) >= span or start == 0:
+            return start + console_offset(output[start:], max(len(tail) - span, 0))
+        end = start - 1
+
+# Console logs are scanned in chunks of this size, so that runaway recipes
+# with enormous console logs don't need to be read into memory all at once
+CONSOLE_CHUNK_SIZE = 4 * 1024 * 1024
+
+def read_console_log(filename, span, normalize=False):
+    """
+    Yields (offset, chunk) for overlapping chunks of a console log, where
+    offset is the position in the log where the chunk starts. Each chunk
+    starts with the last span bytes of the previous one, so any match no
+    longer than span bytes is found in at least one chunk. If normalize is
+    true the chunks are passed through normalize_console(), and span applies
+    to the normalized output. See console_log_offset() for finding where a
+    match in a normalized chunk is in the log.
+    """
+    with open(filename, 'rb') as f:
+        offset = 0
+        overlap = b''
+        # the part of the log which overlap was normalized from
+        overlap_raw = b''
+        pending = b''
+        while True:
+            data = f.read(CONSOLE_CHUNK_SIZE)
+            chunk = pending + data
+            pending = b''
+            if not chunk:
+                break
+            if normalize:
+                if data:
+                    # Hold back a possible escape sequence at the end of the
+                    # chunk, in case the rest of it is in the next chunk.
+                    escape = chunk.rfind(b'\x1b', -32)
+                    if escape != -1:
+                        chunk, pending = chunk[:escape], chunk[escape:]
+                raw = overlap_raw + chunk
+                chunk = normalize_console(chunk)
+            buf = overlap + chunk
+            yield offset, buf
+            overlap = buf[-span:]
+            if normalize:
+                tail = _normalized_tail_offset(raw, span)
+                overlap_raw = raw[tail:]
+                offset += tail
+            else:
+                offset += len(buf) - len(overlap)
+
+def console_log_offset(filename, offset, normalized_offset):
+    """
+    Returns the position in a console log of the byte at normalized_offset in
+    a normalized chunk which read_console_log() yielded at offset.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        raw = b''
+        while True:
+            data = f.read(CONSOLE_CHUNK_SIZE)
+            raw += data
+            position = console_offset(raw, normalized_offset)
+            # Stay clear of the end, where an escape sequence might be cut off
+            if position < len(raw) - 64 or not data:
+                return offset + position
 
 class KnownIssue(object):
 
-    def __init__(self, description, bug_id=None, failure_patterns=None, console_patterns=None):
+    def __init__(self, description, bug_id=None, failure_patterns=None, console_patterns=None,
+            normalized_console_patterns=None, console_span=4096):
         self.description = description
         self.bug_id = bug_id
+        # Console patterns are only guaranteed to be found if they match
+        # within this many bytes, see read_console_log()
+        self.console_span = console_span
         self.failure_patterns = [re.compile(patt, re.DOTALL)
                 for patt in (failure_patterns or [])]
         self.console_patterns = [re.compile(patt, re.DOTALL)
                 for patt in (console_patterns or [])]
+        # These are matched against normalize_console() output instead
+        self.normalized_console_patterns = [re.compile(patt, re.DOTALL)
+                for patt in (normalized_console_patterns or [])]
+
+    def fingerprint(self, patterns_attr):
+        """
+        Identifies the patterns of the given kind, so that cached results can
+        be reused for as long as the patterns are not changed.
+        """
+        key = [patterns_attr] + [(pattern.pattern, pattern.flags)
+                for pattern in getattr(self, patterns_attr)]
+        if patterns_attr != 'failure_patterns':
+            key.append(self.console_span)
+        return hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+
+class IssueMatcher(object):
+    """
+    Finds which of many known issues match some output, by combining all of
+    their patterns into one regexp with a named group for each issue. That
+    way each piece of output is scanned once, rather than once per pattern.
+    """
 
-    def matches_nose_output(self, output):
-        if not self.failure_patterns:
-            return False
-        failures = re.split(rb'={70}\n|-{70}\nRan ', output)[1:-1]
-        for failure in failures:
-            for failure_pattern in self.failure_patterns:
-                if failure_pattern.search(failure):
-                    return True
-        return False
-
-    def matches_console_output(self, output):
-        if not self.console_patterns:
-            return False
-        for console_pattern in self.console_patterns:
-            if console_pattern.search(output):
-                return True
-        return False
+    def __init__(self, issues, patterns_attr):
+        self.patterns_attr = patterns_attr
+        self.issues = [issue for issue in issues if getattr(issue, patterns_attr)]
+        self._combined_patterns = {}
+
+    def _combined_pattern(self, issues):
+        # Once an issue has matched we stop looking for it, so there is one
+        # combined pattern for each set of issues still to be found.
+        key = tuple(self.issues.index(issue) for issue in issues)
+        if key not in self._combined_patterns:
+            self._combined_patterns[key] = re.compile(b'|'.join(
+                    b'(?P<issue%d>%s)' % (index, b'|'.join(b'(?:%s)' % pattern.pattern
+                        for pattern in getattr(self.issues[index], self.patterns_attr)))
+                    for index in key), re.DOTALL)
+        return self._combined_patterns[key]
+
+    def fingerprints(self):
+        return dict((issue, issue.fingerprint(self.patterns_attr)) for issue in self.issues)
+
+    def console_span(self, issues=None):
+        return max(issue.console_span for issue in (issues or self.issues))
+
+    def matching_issues(self, outputs, issues=None):
+        """
+        Returns the set of issues (out of the given issues, or all of them)
+        which match any of outputs.
+        """
+        if issues is None:
+            issues = self.issues
+        matched = set()
+        if not issues:
+            return matched
+        for output in outputs:
+            remaining = [issue for issue in issues if issue not in matched]
+            if not remaining:
+                break
+            while remaining:
+                match = self._combined_pattern(remaining).search(output)
+                if not match:
+                    break
+                group = next(name for name, value in match.groupdict().items()
+                        if value is not None)
+                issue = self.issues[int(group[len('issue'):])]
+                matched.add(issue)
+                remaining.remove(issue)
+        return matched
 
 known_issues = [
     KnownIssue(
@@ -59,15 +223,15 @@ known_issues = [
     ),
     KnownIssue(
         description='/boot corrupted',
-        console_patterns=[
+        normalized_console_patterns=[
             # error: not a correct XFS inode.
-            rb'e\s*r\s*r\s*o\s*r\s*:\s+n\s*o\s*t\s+a\s+c\s*o\s*r\s*r\s*e\s*c\s*t\s+X\s*F\s*S\s+i\s*n\s*o\s*d\s*e\s*\.',
+            rb'error:notacorrectXFSinode\.',
             # error: attempt to read or write outside of partition.
-            rb'e\s*r\s*r\s*o\s*r\s*:\s+a\s*t\s*t\s*e\s*m\s*p\s*t\s+t\s*o\s+r\s*e\s*a\s*d\s+o\s*r\s+w\s*r\s*i\s*t\s*e\s+o\s*u\s*t\s*s\s*i\s*d\s*e\s+o\s*f\s+p\s*a\s*r\s*t\s*i\s*t\s*i\s*o\s*n\s*\.',
+            rb'error:attempttoreadorwriteoutsideofpartition\.',
             # alloc magic is broken at 0x
-            rb'a\s*l\s*l\s*o\s*c\s+m\s*a\s*g\s*i\s*c\s+i\s*s\s+b\s*r\s*o\s*k\s*e\s*n\s+a\s*t\s+0\s*x',
+            rb'allocmagicisbrokenat0x',
             # error: file `/grub2/i386-pc/bufio.mod' not found.
-            rb'e\s*r\s*r\s*o\s*r\s*:\s+f\s*i\s*l\s*e\s+`.*\.\s*m\s*o\s*d\s*\'\s+n\s*o\s*t\s+f\s*o\s*u\s*n\s*d\s*\.',
+            rb"error:file`[^`']*\.mod'notfound\.",
         ],
     ),
     KnownIssue(
@@ -173,22 +337,86 @@ def all_weeks():
         yield (year, isoweek)
         d += datetime.timedelta(days=7)
 
-def stats():
+class MatchCache(object):
+    """
+    On-disk cache of which known issues matched each log file. Results are
+    keyed by KnownIssue.fingerprint(), so that adding or editing a known issue
+    only re-scans the logs for that issue. A log's results are discarded if
+    its mtime or size changes.
+    """
+
+    def __init__(self, filename):
+        if filename != ':memory:':
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS match (
+                filename TEXT NOT NULL,
+                mtime REAL NOT NULL,
+                size INTEGER NOT NULL,
+                fingerprint TEXT NOT NULL,
+                matched INTEGER NOT NULL,
+                PRIMARY KEY (filename, fingerprint)
+            )""")
+        self.logs = {}
+        for filename, mtime, size, fingerprint, matched in self.conn.execute('SELECT * FROM match'):
+            self.logs.setdefault(filename, (mtime, size, {}))[2][fingerprint] = bool(matched)
+        self.updated = set()
+
+    def get(self, filename, mtime, size): # -> dict of fingerprint -> matched
+        if filename not in self.logs or self.logs[filename][:2] != (mtime, size):
+            self.logs[filename] = (mtime, size, {})
+        return self.logs[filename][2]
+
+    def put(self, filename, results):
+        self.logs[filename][2].update(results)
+        self.updated.add(filename)
+
+    def save(self):
+        with self.conn:
+            for filename in self.updated:
+                mtime, size, results = self.logs[filename]
+                self.conn.execute('DELETE FROM match WHERE filename = ?', (filename,))
+                self.conn.executemany('INSERT INTO match VALUES (?, ?, ?, ?, ?)',
+                        [(filename, mtime, size, fingerprint, matched)
+                         for fingerprint, matched in results.items()])
+        self.updated = set()
+
+def cached_matching_issues(cache, matcher, fingerprints, filename, read_outputs):
+    """
+    Returns the set of issues which match the log in filename, only calling
+    read_outputs(issues) to scan the log for issues not already in the cache.
+    """
+    stat = os.stat(filename)
+    results = cache.get(filename, stat.st_mtime, stat.st_size)
+    unknown = [issue for issue in matcher.issues if fingerprints[issue] not in results]
+    if unknown:
+        matched = matcher.matching_issues(read_outputs(unknown), unknown)
+        cache.put(filename, dict((fingerprints[issue], issue in matched) for issue in unknown))
+    return set(issue for issue in matcher.issues if results[fingerprints[issue]])
+
+def stats(cache_filename=CACHE_FILENAME):
     all_jobs = []
     known_issue_occurrences = {known_issue: [] for known_issue in known_issues}
-    for jobdir in dogfood_job_dirs():
-        if not os.path.exists(os.path.join(jobdir, 'beaker')):
+    cache = MatchCache(cache_filename or ':memory:')
+    nose_matcher = IssueMatcher(known_issues, 'failure_patterns')
+    console_matcher = IssueMatcher(known_issues, 'console_patterns')
+    normalized_console_matcher = IssueMatcher(known_issues, 'normalized_console_patterns')
+    nose_fingerprints = nose_matcher.fingerprints()
+    console_fingerprints = console_matcher.fingerprints()
+    normalized_console_fingerprints = normalized_console_matcher.fingerprints()
+    for job in dogfood_jobs():
+        if not job.has_beaker:
             continue
-        resultsdir, = glob(os.path.join(jobdir, 'beaker', 'J:*'))
-        resultsfile = os.path.join(resultsdir, 'results.xml')
-        if os.path.getsize(resultsfile) == 0:
+        resultsdir = job.resultsdir
+        if job.resultsxml_size == 0:
             continue # Jenkins job died while watching the Beaker job
-        results = lxml.etree.parse(open(resultsfile, 'rb'))
+        results = lxml.etree.parse(open(os.path.join(resultsdir, 'results.xml'), 'rb'))
         recipe_status, = results.xpath('/job/recipeSet/recipe/@status')
         if recipe_status not in ['Completed', 'Aborted']:
             continue
         # This is not great, but we don't have finish_time in results.xml
-        timestamp = datetime.datetime.fromtimestamp(os.path.getmtime(resultsdir))
+        timestamp = datetime.datetime.fromtimestamp(job.resultsdir_mtime)
         # Test nose output against known issues
         nose_result = results.xpath('/job/recipeSet/recipe/task/results/result[@path="/distribution/beaker/dogfood/tests"]')
         if nose_result:
@@ -199,19 +427,27 @@ def stats():
             if result_logs:
                 nose_log_filename = os.path.join(resultsdir, '%s-%s' % (nose_result[0].get('id'), result_logs[0].get('name')))
                 if os.path.exists(nose_log_filename):
-                    nose_output = open(nose_log_filename, 'rb').read()
-                    for known_issue in known_issues:
-                        if known_issue.matches_nose_output(nose_output):
-                            known_issue_occurrences[known_issue].append(timestamp)
+                    for known_issue in cached_matching_issues(cache, nose_matcher,
+                            nose_fingerprints, nose_log_filename,
+                            lambda issues: nose_failures(open(nose_log_filename, 'rb').read())):
+                        known_issue_occurrences[known_issue].append(timestamp)
         # Test console log against known issues
         recipe_id, = results.xpath('/job/recipeSet/recipe/@id')
         console_log_filename = os.path.join(resultsdir, '%s-console.log' % recipe_id)
         if os.path.exists(console_log_filename):
-            console_output = open(console_log_filename, 'rb').read()
-            for known_issue in known_issues:
-                if known_issue.matches_console_output(console_output):
-                    known_issue_occurrences[known_issue].append(timestamp)
+            matched = cached_matching_issues(cache, console_matcher,
+                    console_fingerprints, console_log_filename,
+                    lambda issues: (chunk for offset, chunk in read_console_log(
+                        console_log_filename, console_matcher.console_span(issues))))
+            matched |= cached_matching_issues(cache, normalized_console_matcher,
+                    normalized_console_fingerprints, console_log_filename,
+                    lambda issues: (chunk for offset, chunk in read_console_log(
+                        console_log_filename, normalized_console_matcher.console_span(issues),
+                        normalize=True)))
+            for known_issue in matched:
+                known_issue_occurrences[known_issue].append(timestamp)
         all_jobs.append(timestamp)
+    cache.save()
     for known_issue, occurrences in known_issue_occurrences.items():
         if not occurrences:
             print('WARNING: known issue %r did not match any jobs, bad pattern?' % known_issue.description, file=sys.stderr)
@@ -300,7 +536,13 @@ def page(known_issue_occurrences, all_jobs):
     """ % (all_summary, '\n'.join(summaries), datetime.datetime.utcnow().isoformat() + 'Z')
 
 def main():
-    print(page(*stats()))
+    parser = ArgumentParser(description='Reports on occurrences of known issues in dogfood jobs')
+    parser.add_argument('--cache', metavar='FILE', default=CACHE_FILENAME,
+                        help='Keep known issue match results in FILE [default: %(default)s]')
+    parser.add_argument('--no-cache', action='store_const', dest='cache', const=None,
+                        help='Scan all logs from scratch without using a cache')
+    options = parser.parse_args()
+    print(page(*stats(cache_filename=options.cache)))
 
 if __name__ == '__main__':
     main()
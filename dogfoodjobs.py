@@ -0,0 +1,59 @@
+"""
+Finds dogfood job results under /srv/www/jenkins-results. Shared by
+dogfoodstats.py and dogfood-known-issues.py.
+"""
+
+import os
+from collections import namedtuple
+
+# Directories containing one subdirectory per Jenkins build, and the first
+# build number in each which is worth looking at (or None for all of them)
+JOB_ROOTS = [
+    ('/srv/www/jenkins-results/beaker-review-checks-dogfood-RedHatEnterpriseLinux6', None),
+    # builds before #49 were busted
+    ('/srv/www/jenkins-results/beaker-review-checks-dogfood-RedHatEnterpriseLinux7', 49),
+]
+
+# resultsdir is the beaker/J:* directory, or None if the job has no Beaker
+# results. The results.xml fields are None if the file does not exist.
+Job = namedtuple('Job', ['jobdir', 'mtime', 'has_beaker', 'resultsdir', 'resultsdir_mtime',
+        'resultsxml_size', 'resultsxml_mtime'])
+
+def _job(entry):
+    resultsdir = resultsdir_mtime = resultsxml_size = resultsxml_mtime = None
+    try:
+        with os.scandir(os.path.join(entry.path, 'beaker')) as beaker_entries:
+            resultsdir_entries = [e for e in beaker_entries if e.name.startswith('J:')]
+    except FileNotFoundError:
+        has_beaker = False
+    else:
+        has_beaker = True
+        resultsdir_entry, = resultsdir_entries
+        resultsdir = resultsdir_entry.path
+        resultsdir_mtime = resultsdir_entry.stat().st_mtime
+        try:
+            resultsxml_stat = os.stat(os.path.join(resultsdir, 'results.xml'))
+        except FileNotFoundError:
+            pass
+        else:
+            resultsxml_size = resultsxml_stat.st_size
+            resultsxml_mtime = resultsxml_stat.st_mtime
+    return Job(entry.path, entry.stat().st_mtime, has_beaker, resultsdir, resultsdir_mtime,
+            resultsxml_size, resultsxml_mtime)
+
+def dogfood_jobs(roots=None, min_mtime=None):
+    """
+    Yields a Job for each build under the given roots (default JOB_ROOTS),
+    skipping builds whose directory was last modified before min_mtime.
+    Directories are walked with os.scandir() and each stat result is fetched
+    once, which matters on the NFS-backed results host. Skipped builds cost
+    only the stat of their directory.
+    """
+    for root, first_build in (JOB_ROOTS if roots is None else roots):
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if first_build is not None and int(entry.name) < first_build:
+                    continue
+                if min_mtime is not None and entry.stat().st_mtime < min_mtime:
+                    continue
+                yield _job(entry)
@@ -1,27 +1,26 @@
 #!/usr/bin/python3
 
 import os
+import sys
 import time
-from glob import glob
+from argparse import ArgumentParser
+import concurrent.futures
+import bisect
 import math
 from collections import namedtuple
 import datetime
 import json
 import re
+import sqlite3
 import lxml.etree
 
+from dogfoodjobs import dogfood_jobs
+
 max_job_age = 2 * 365 * 24 * 60 * 60 # 2 years
 min_job_mtime = time.time() - max_job_age
 
-def dogfood_job_dirs():
-    el6dir = '/srv/www/jenkins-results/beaker-review-checks-dogfood-RedHatEnterpriseLinux6'
-    for jobnum in os.listdir(el6dir):
-        yield os.path.join(el6dir, jobnum)
-    el7dir = '/srv/www/jenkins-results/beaker-review-checks-dogfood-RedHatEnterpriseLinux7'
-    for jobnum in os.listdir(el7dir):
-        if int(jobnum) < 49:
-            continue # builds before #49 were busted
-        yield os.path.join(el7dir, jobnum)
+# Extracted details of each job are kept here between runs
+INDEX_FILENAME = os.path.expanduser('~/.cache/beaker-administrivia/dogfoodstats.sqlite')
 
 invalid_recipe_ids = [ # These are excluded from the stats to avoid skewing them
     # Xvfb was broken, skipping all WebDriver cases
@@ -103,85 +102,219 @@ def log_filename_for_result(resultsxml, resultsdir, result_name): # -> filename
         return None
     return filename
 
-def stats():
-    rowtype = namedtuple('Row', ['timestamp', 'hours_ran', 'recipeid', 'hostgroup', 'hostname'])
-    rows = []
-    for jobdir in dogfood_job_dirs():
-        if os.path.getmtime(jobdir) < min_job_mtime:
-            continue
-        if not os.path.exists(os.path.join(jobdir, 'beaker')):
-            continue
-        resultsdir, = glob(os.path.join(jobdir, 'beaker', 'J:*'))
-        results = lxml.etree.parse(open(os.path.join(resultsdir, 'results.xml'), 'rb'))
-        sysinfo_log_filename = log_filename_for_result(results, resultsdir, '/distribution/install/Sysinfo')
-        if not sysinfo_log_filename:
-            continue
-        hostname_match = re.search(r'Hostname                = (.*)$', open(sysinfo_log_filename).read(), re.M)
-        if not hostname_match:
-            raise ValueError('Log %s does not contain hostname' % sysinfo_log_filename)
-        hostname = hostname_match.group(1)
-        hostgroup = hostname_to_group(hostname)
-        job_whiteboard = results.xpath('/job/whiteboard/text()')[0].strip()
-        if any(re.match(p, job_whiteboard) for p in invalid_job_whiteboard_patterns):
-            continue
-        recipeid, = results.xpath('/job/recipeSet/recipe/@id')
-        if recipeid in invalid_recipe_ids:
-            continue
-        family, = results.xpath('/job/recipeSet/recipe/@family')
-        family = family.replace('RedHatEnterpriseLinux', 'RHEL')
-        hostgroup = '%s[%s]' % (hostgroup, family)
-        recipe_status, = results.xpath('/job/recipeSet/recipe/@status')
-        if recipe_status != 'Completed':
-            continue
-        setup_result, = results.xpath('/job/recipeSet/recipe/task[@name="/distribution/beaker/setup"]/@result')
-        if setup_result != 'Pass':
-            continue # tests are likely invalid
-        nose_log_filename = log_filename_for_result(results, resultsdir, '/distribution/beaker/dogfood/tests')
-        if not nose_log_filename:
-            continue
-        test_count_match = re.search(r'^Ran (\d+) tests in .*s$', open(nose_log_filename).read(), re.M)
-        if not test_count_match:
+Row = namedtuple('Row', ['timestamp', 'hours_ran', 'recipeid', 'hostgroup', 'hostname'])
+
+# What we extracted from a job's results, as stored in the job index. Either
+# skip_reason is set, or the remaining fields describe a usable recipe run.
+JobInfo = namedtuple('JobInfo', ['mtime', 'whiteboard', 'recipeid', 'family',
+        'hostname', 'hours_ran', 'skip_reason'])
+
+def extract_job(resultsdir, mtime):
+    """
+    Parses results.xml and the logs in resultsdir. This is the expensive part
+    of the stats, so the results are kept in a JobIndex.
+    """
+    def skipped(reason, whiteboard=None):
+        return JobInfo(mtime, whiteboard, None, None, None, None, reason)
+    results = lxml.etree.parse(open(os.path.join(resultsdir, 'results.xml'), 'rb'))
+    job_whiteboard = results.xpath('/job/whiteboard/text()')[0].strip()
+    sysinfo_log_filename = log_filename_for_result(results, resultsdir, '/distribution/install/Sysinfo')
+    if not sysinfo_log_filename:
+        return skipped('no Sysinfo log', job_whiteboard)
+    hostname_match = re.search(r'Hostname                = (.*)$', open(sysinfo_log_filename).read(), re.M)
+    if not hostname_match:
+        raise ValueError('Log %s does not contain hostname' % sysinfo_log_filename)
+    hostname = hostname_match.group(1)
+    recipeid, = results.xpath('/job/recipeSet/recipe/@id')
+    family, = results.xpath('/job/recipeSet/recipe/@family')
+    recipe_status, = results.xpath('/job/recipeSet/recipe/@status')
+    if recipe_status != 'Completed':
+        return skipped('recipe %s' % recipe_status, job_whiteboard)
+    setup_result, = results.xpath('/job/recipeSet/recipe/task[@name="/distribution/beaker/setup"]/@result')
+    if setup_result != 'Pass':
+        return skipped('setup %s' % setup_result, job_whiteboard) # tests are likely invalid
+    nose_log_filename = log_filename_for_result(results, resultsdir, '/distribution/beaker/dogfood/tests')
+    if not nose_log_filename:
+        return skipped('no nose log', job_whiteboard)
+    test_count_match = re.search(r'^Ran (\d+) tests in .*s$', open(nose_log_filename).read(), re.M)
+    if not test_count_match:
+        return skipped('no test count', job_whiteboard)
+    test_count = int(test_count_match.group(1))
+    if test_count < 1000:
+        return skipped('only %d tests ran' % test_count, job_whiteboard)
+    duration_text, = results.xpath('/job/recipeSet/recipe/@duration')
+    duration = parse_beaker_duration(duration_text)
+    hours_ran = duration.total_seconds() / 3600.
+    return JobInfo(mtime, job_whiteboard, recipeid, family, hostname, hours_ran, None)
+
+def job_row(info): # -> Row or None if the job is excluded from the stats
+    if info.skip_reason:
+        return None
+    # The exclusion lists and host groups are applied here rather than in
+    # extract_job(), so that editing them takes effect without re-parsing.
+    if any(re.match(p, info.whiteboard) for p in invalid_job_whiteboard_patterns):
+        return None
+    if info.recipeid in invalid_recipe_ids:
+        return None
+    family = info.family.replace('RedHatEnterpriseLinux', 'RHEL')
+    hostgroup = '%s[%s]' % (hostname_to_group(info.hostname), family)
+    # This is not great, but we don't have finish_time in results.xml
+    timestamp = datetime.datetime.fromtimestamp(info.mtime)
+    return Row(timestamp, info.hours_ran, info.recipeid, hostgroup, info.hostname)
+
+class JobIndex(object):
+    """
+    On-disk index of JobInfo for each job dir, so that finished jobs are only
+    parsed once. An entry is reused as long as the mtime of the job's results
+    dir and the mtime and size of its results.xml have not changed. (Rewriting
+    results.xml in place does not touch the directory's mtime.)
+    """
+
+    def __init__(self, filename):
+        if filename != ':memory:':
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.conn = sqlite3.connect(filename)
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(job)')]
+        if columns and 'resultsxml_size' not in columns:
+            # index from an older version, just start again
+            with self.conn:
+                self.conn.execute('DROP TABLE job')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS job (
+                jobdir TEXT PRIMARY KEY,
+                mtime REAL NOT NULL,
+                whiteboard TEXT,
+                recipeid TEXT,
+                family TEXT,
+                hostname TEXT,
+                hours_ran REAL,
+                skip_reason TEXT,
+                resultsxml_mtime REAL,
+                resultsxml_size INTEGER
+            )""")
+        # jobdir -> (JobInfo, results.xml mtime, results.xml size)
+        self.jobs = dict((row[0], (JobInfo(*row[1:8]),) + row[8:])
+                for row in self.conn.execute('SELECT * FROM job'))
+        self.updated = {}
+
+    def get(self, job): # -> JobInfo or None if missing or stale
+        entry = self.jobs.get(job.jobdir)
+        if entry is None:
+            return None
+        info, resultsxml_mtime, resultsxml_size = entry
+        if (info.mtime, resultsxml_mtime, resultsxml_size) != \
+                (job.resultsdir_mtime, job.resultsxml_mtime, job.resultsxml_size):
+            return None
+        return info
+
+    def put(self, job, info):
+        self.jobs[job.jobdir] = self.updated[job.jobdir] = \
+                (info, job.resultsxml_mtime, job.resultsxml_size)
+
+    def save(self, seen_jobdirs):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO job VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [(jobdir,) + tuple(info) + (resultsxml_mtime, resultsxml_size)
+                     for jobdir, (info, resultsxml_mtime, resultsxml_size) in self.updated.items()])
+            # forget about jobs which have been deleted or aged out
+            self.conn.executemany('DELETE FROM job WHERE jobdir = ?',
+                    [(jobdir,) for jobdir in set(self.jobs) - set(seen_jobdirs)])
+        self.updated = {}
+
+def extract_jobs(resultsdirs_mtimes, jobs=1): # -> list of JobInfo in the same order
+    if jobs <= 1 or len(resultsdirs_mtimes) <= 1:
+        return [extract_job(resultsdir, mtime) for resultsdir, mtime in resultsdirs_mtimes]
+    # Parsing is CPU bound so fan it out to worker processes. Executor.map
+    # returns results in order, so the output does not depend on scheduling.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(extract_job,
+                [resultsdir for resultsdir, mtime in resultsdirs_mtimes],
+                [mtime for resultsdir, mtime in resultsdirs_mtimes],
+                chunksize=16))
+
+def smooth(hostrows, averages_by_row, upper_variances_by_row, lower_variances_by_row, epsilon=0):
+    """
+    Fills in the averages and variances for each of hostrows, which must be
+    sorted by timestamp.
+
+    If epsilon is non-zero (it must be between 0 and 1), other rows whose
+    weight would be less than epsilon are left out. Those are found by bisecting the timestamps, so the cost is
+    proportional to the number of rows within the window instead of all rows.
+    Returns an upper bound on the fraction of the total weight which was left
+    out for any row.
+    """
+    # compute centred exponential weighted mean and variance for each point except the edge-most ones
+    # http://tdunning.blogspot.com.au/2011/03/exponential-weighted-averages-with.html
+    # http://nfs-uxsup.csx.cam.ac.uk/~fanf2/hermes/doc/antiforgery/stats.pdf
+    alpha = 5 # smoothing factor
+    timestamps = [row.timestamp for row in hostrows]
+    if epsilon:
+        if not 0 < epsilon < 1:
+            raise ValueError('epsilon must be between 0 and 1, not %r' % epsilon)
+        window = datetime.timedelta(days=-alpha * math.log(epsilon))
+    truncation_error = 0.
+    for i, row in enumerate(hostrows):
+        if i < 3 or i > len(hostrows) - 3:
             continue
-        test_count = int(test_count_match.group(1))
-        if test_count < 1000:
+        if epsilon:
+            start = bisect.bisect_left(timestamps, row.timestamp - window)
+            end = bisect.bisect_right(timestamps, row.timestamp + window)
+        else:
+            start, end = 0, len(hostrows)
+        window_rows = hostrows[start:end]
+        weights = [math.exp(-(abs((row.timestamp - other_row.timestamp).total_seconds()) / (24*60*60)) / alpha)
+                for other_row in window_rows]
+        average = (
+            sum(weight * other_row.hours_ran
+                for other_row, weight in zip(window_rows, weights))
+          / sum(weights))
+        averages_by_row[row] = average
+        upper_variances_by_row[row] = (
+            sum(weight * (other_row.hours_ran - average)**2
+                for other_row, weight in zip(window_rows, weights)
+                if other_row.hours_ran > average)
+          / sum(weights))
+        lower_variances_by_row[row] = (
+            sum(weight * (other_row.hours_ran - average)**2
+                for other_row, weight in zip(window_rows, weights)
+                if other_row.hours_ran <= average)
+          / sum(weights))
+        # each row outside the window weighs less than epsilon
+        left_out = len(hostrows) - len(window_rows)
+        truncation_error = max(truncation_error, min(1., left_out * epsilon / sum(weights)))
+    return truncation_error
+
+def stats(index_filename=INDEX_FILENAME, jobs=1, epsilon=0):
+    index = JobIndex(index_filename or ':memory:')
+    infos = {}
+    unindexed = []
+    for job in dogfood_jobs(min_mtime=min_job_mtime):
+        if not job.resultsdir:
             continue
-        duration_text, = results.xpath('/job/recipeSet/recipe/@duration')
-        duration = parse_beaker_duration(duration_text)
-        hours_ran = duration.total_seconds() / 3600.
-        # This is not great, but we don't have finish_time in results.xml
-        timestamp = datetime.datetime.fromtimestamp(os.path.getmtime(resultsdir))
-        rows.append(rowtype(timestamp, hours_ran, recipeid, hostgroup, hostname))
-    rows = sorted(rows, key=lambda r: r.timestamp)
+        infos[job.jobdir] = index.get(job)
+        if infos[job.jobdir] is None:
+            unindexed.append(job)
+    extracted = extract_jobs([(job.resultsdir, job.resultsdir_mtime) for job in unindexed], jobs)
+    for job, info in zip(unindexed, extracted):
+        infos[job.jobdir] = info
+        index.put(job, info)
+    index.save(infos.keys())
+    rows = [row for row in (job_row(info) for info in infos.values()) if row]
+    rows = sorted(rows, key=lambda r: (r.timestamp, r.recipeid))
     all_hostgroups = sorted(set(row.hostgroup for row in rows))
     averages_by_row = {}
     upper_variances_by_row = {}
     lower_variances_by_row = {}
+    truncation_error = 0.
     for hostgroup in all_hostgroups:
         hostrows = [row for row in rows if row.hostgroup == hostgroup]
-        # compute centred exponential weighted mean and variance for each point except the edge-most ones
-        # http://tdunning.blogspot.com.au/2011/03/exponential-weighted-averages-with.html
-        # http://nfs-uxsup.csx.cam.ac.uk/~fanf2/hermes/doc/antiforgery/stats.pdf
-        alpha = 5 # smoothing factor
-        for i, row in enumerate(hostrows):
-            if i < 3 or i > len(hostrows) - 3:
-                continue
-            weights = [math.exp(-(abs((row.timestamp - other_row.timestamp).total_seconds()) / (24*60*60)) / alpha)
-                    for other_row in hostrows]
-            average = (
-                sum(weight * other_row.hours_ran
-                    for other_row, weight in zip(hostrows, weights))
-              / sum(weights))
-            averages_by_row[row] = average
-            upper_variances_by_row[row] = (
-                sum(weight * (other_row.hours_ran - average)**2
-                    for other_row, weight in zip(hostrows, weights)
-                    if other_row.hours_ran > average)
-              / sum(weights))
-            lower_variances_by_row[row] = (
-                sum(weight * (other_row.hours_ran - average)**2
-                    for other_row, weight in zip(hostrows, weights)
-                    if other_row.hours_ran <= average)
-              / sum(weights))
+        hostgroup_truncation_error = smooth(hostrows,
+                averages_by_row, upper_variances_by_row, lower_variances_by_row,
+                epsilon=epsilon)
+        truncation_error = max(truncation_error, hostgroup_truncation_error)
+    if epsilon:
+        print('Smoothing ignored at most %.3g%% of the weight for any point'
+                % (truncation_error * 100), file=sys.stderr)
     google_cols = [
         {'id': 'finished', 'type': 'datetime'},
         {'id': 'hours_ran', 'type': 'number'},
@@ -268,7 +401,21 @@ def page(table):
     """ % (JSONEncoderWithDate().encode(table), datetime.datetime.utcnow().isoformat() + 'Z')
 
 def main():
-    print(page(stats()))
+    parser = ArgumentParser(description='Reports on the running time of dogfood jobs')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help='Parse job results using N processes [default: %(default)s]')
+    parser.add_argument('--index', metavar='FILE', default=INDEX_FILENAME,
+                        help='Keep extracted job details in FILE [default: %(default)s]')
+    parser.add_argument('--no-index', action='store_const', dest='index', const=None,
+                        help='Parse all jobs from scratch without using an index')
+    parser.add_argument('--epsilon', metavar='WEIGHT', type=float, default=0,
+                        help='Ignore rows weighing less than WEIGHT when smoothing, '
+                             'e.g. 1e-6 [default: use all rows]')
+    options = parser.parse_args()
+    if options.epsilon and not 0 < options.epsilon < 1:
+        parser.error('--epsilon must be between 0 and 1')
+    print(page(stats(index_filename=options.index, jobs=options.jobs,
+            epsilon=options.epsilon)))
 
 if __name__ == '__main__':
     main()
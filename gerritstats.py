@@ -1,9 +1,13 @@
 #!/usr/bin/python3
 
+import bisect
 import math
+from argparse import ArgumentParser
 from collections import namedtuple
+import concurrent.futures
 import datetime
 import json
+import sqlite3
 import requests
 
 # using businesstime from a submodule for now, since it needs Dan's fork for 
@@ -20,89 +24,247 @@ class RedHatBrisbaneHolidays(BrisbanePublicHolidays):
         datetime.date(2016, 12, 23), datetime.date(2016, 12, 28), datetime.date(2016, 12, 29), datetime.date(2016, 12, 30),
     ]
 
-GERRIT_CHANGES_URL = 'http://gerrit.beaker-project.org/changes/?q=project:beaker&o=ALL_REVISIONS&o=MESSAGES&o=DETAILED_ACCOUNTS&n=500'
+GERRIT_URL = 'http://gerrit.beaker-project.org'
+GERRIT_CHANGES_QUERY = 'project:beaker'
+GERRIT_CHANGES_OPTIONS = ['ALL_REVISIONS', 'MESSAGES', 'DETAILED_ACCOUNTS']
+GERRIT_PAGE_SIZE = 500 # Gerrit's default query limit
+GERRIT_CONCURRENT_PAGES = 4
 NON_HUMAN_REVIEWERS = ['patchbot', 'jenkins']
 POSTED_SINCE = datetime.datetime.utcnow() - datetime.timedelta(days=365)
 
+# Changes fetched from Gerrit are kept here between runs
+STORE_FILENAME = os.path.expanduser('~/.cache/beaker-administrivia/gerritstats.sqlite')
+
 tzoffset = datetime.timedelta(hours=10) # our business hours are in UTC+10
 business_time = BusinessTime(
         business_hours=(datetime.time(6), datetime.time(18)),
         holidays=RedHatBrisbaneHolidays())
 
+class BusinessCalendar(object):
+    """
+    Cumulative business time at the start of each day from the start date
+    onwards, so that the business time between two datetimes is a lookup and
+    a subtraction, instead of businesstimedelta() stepping through every
+    weekend and holiday in between. Days are added as later datetimes come
+    up. Datetimes before the start fall back to businesstimedelta().
+    """
+
+    def __init__(self, business_time, start):
+        self.business_time = business_time
+        self.start = start
+        self.open_seconds = business_time.open_hours.seconds
+        opening, closing = business_time.business_hours
+        self.opening_seconds = opening.hour * 3600 + opening.minute * 60 + opening.second
+        self.closing = closing
+        # cumulative[i] is the business seconds before day i, business_days[i]
+        # is whether day i is a business day
+        self.cumulative = [0]
+        self.business_days = []
+
+    def _index(self, dt):
+        index = (dt.date() - self.start).days
+        if index < 0:
+            return None
+        while len(self.business_days) <= index:
+            day = self.start + datetime.timedelta(days=len(self.business_days))
+            is_business_day = self.business_time.isbusinessday(day)
+            self.business_days.append(is_business_day)
+            self.cumulative.append(self.cumulative[-1] +
+                    (self.open_seconds if is_business_day else 0))
+        return index
+
+    def _business_seconds(self, index, dt):
+        seconds = self.cumulative[index]
+        if self.business_days[index]:
+            since_opening = (dt.hour * 3600 + dt.minute * 60 + dt.second
+                    - self.opening_seconds)
+            seconds += min(max(since_opening, 0), self.open_seconds)
+        return seconds
+
+    def business_days_between(self, d1, d2):
+        """
+        Returns the business time between d1 and d2 as a fractional number of
+        business days.
+        """
+        index1 = self._index(d1)
+        index2 = self._index(d2)
+        if index1 is None or index2 is None or d1 > d2:
+            delta = self.business_time.businesstimedelta(d1, d2)
+            return delta.days + float(delta.seconds) / self.open_seconds
+        # businesstimedelta() counts nothing from after hours on one business
+        # day to after hours on the next, rather than the whole day in
+        # between. Match it, so that the figures don't shift.
+        if (index1 < index2 and self.business_days[index1] and self.business_days[index2]
+                and self.cumulative[index2] == self.cumulative[index1 + 1]
+                and d1.time() > self.closing and d2.time() >= self.closing):
+            return 0.0
+        seconds = self._business_seconds(index2, d2) - self._business_seconds(index1, d1)
+        days, seconds = divmod(seconds, self.open_seconds)
+        return days + float(seconds) / self.open_seconds
+
 def parse_gerrit_timestamp(timestamp):
     # "2015-09-08 04:39:30.493000000"
     return datetime.datetime.strptime(timestamp[:19], '%Y-%m-%d %H:%M:%S')
 
+def _decayed_upper_sums(positions, values, averages, inclusive, offset=0.0):
+    """
+    For each i, returns the sums of w, w*d and w*d**2 over the earlier points
+    j (and i itself if inclusive) with values[j] > averages[i], where
+    w = exp(positions[j] - positions[i]) and d = values[j] - offset.
+    Positions must be ascending.
+
+    The points are kept in a Fenwick tree indexed by the rank of their value,
+    so each step is O(log n). Weights are stored pre-scaled by
+    exp(position - origin) which means the existing entries never need to be
+    decayed, except for an occasional rescale to avoid overflow.
+    """
+    distinct_values = sorted(set(values))
+    ranks = dict((value, rank) for rank, value in enumerate(distinct_values, 1))
+    size = len(distinct_values)
+    trees = [[0.0] * (size + 1) for _ in range(3)]
+    origin = positions[0] if positions else 0
+    def add(rank, weight, value):
+        while rank <= size:
+            trees[0][rank] += weight
+            trees[1][rank] += weight * value
+            trees[2][rank] += weight * value * value
+            rank += rank & -rank
+    def prefix(rank):
+        sums = [0.0, 0.0, 0.0]
+        while rank > 0:
+            for k in range(3):
+                sums[k] += trees[k][rank]
+            rank -= rank & -rank
+        return sums
+    result = []
+    for i, (position, value, average) in enumerate(zip(positions, values, averages)):
+        if position - origin > 300:
+            factor = math.exp(origin - position)
+            for tree in trees:
+                tree[:] = [x * factor for x in tree]
+            origin = position
+        if inclusive:
+            add(ranks[value], math.exp(position - origin), value - offset)
+        if average is not None:
+            scale = math.exp(origin - position)
+            total = prefix(size)
+            at_or_below = prefix(bisect.bisect_right(distinct_values, average))
+            result.append([(t - b) * scale for t, b in zip(total, at_or_below)])
+        else:
+            result.append(None)
+        if not inclusive:
+            add(ranks[value], math.exp(position - origin), value - offset)
+    return result
+
 # compute centred exponential weighted mean and variance for each point except the edge-most ones
 # http://tdunning.blogspot.com.au/2011/03/exponential-weighted-averages-with.html
 # http://nfs-uxsup.csx.cam.ac.uk/~fanf2/hermes/doc/antiforgery/stats.pdf
+# The weights exp(-|t_i - t_j| / alpha) are separable on each side of i, so
+# the sums are built up by one forward and one backward recursion instead of
+# weighing every point against every other point. Timestamps must be sorted.
 def ewm_var(timestamps, values):
     assert len(timestamps) == len(values)
     alpha = 8 # smoothing factor
+    n = len(timestamps)
+    if n == 0:
+        return [], [], []
+    positions = [(timestamp - timestamps[0]).total_seconds() / (24*60*60) / alpha
+                 for timestamp in timestamps]
+    assert all(a <= b for a, b in zip(positions, positions[1:])), 'timestamps must be sorted'
+    # The sums are taken over deviations from the overall mean rather than
+    # the values themselves, so that expanding the squared deviations below
+    # does not cancel away the precision when the values are large compared
+    # to their spread.
+    offset = math.fsum(values) / n
+    deviations = [value - offset for value in values]
+    # sums[i] = [sum(w), sum(w*d), sum(w*d**2)] over all points j
+    sums = [[0.0, 0.0, 0.0] for _ in range(n)]
+    forward = [0.0, 0.0, 0.0]
+    for i in range(n):
+        decay = math.exp(positions[i - 1] - positions[i]) if i else 0.0
+        forward = [x * decay for x in forward]
+        forward[0] += 1
+        forward[1] += deviations[i]
+        forward[2] += deviations[i] ** 2
+        sums[i] = list(forward)
+    backward = [0.0, 0.0, 0.0]
+    for i in reversed(range(n - 1)):
+        decay = math.exp(positions[i] - positions[i + 1])
+        backward = [(x + y) * decay for x, y in
+                    zip(backward, [1, deviations[i + 1], deviations[i + 1] ** 2])]
+        sums[i] = [x + y for x, y in zip(sums[i], backward)]
     averages = []
+    for i in range(n):
+        if i < 5 or i > n - 5:
+            averages.append(None)
+        else:
+            averages.append(offset + sums[i][1] / sums[i][0])
+    # upper semivariance sums from points at or before i, then after i
+    upper_before = _decayed_upper_sums(positions, values, averages,
+            inclusive=True, offset=offset)
+    upper_after = _decayed_upper_sums([-p for p in reversed(positions)],
+            list(reversed(values)), list(reversed(averages)),
+            inclusive=False, offset=offset)[::-1]
     upper_variances = []
     lower_variances = []
-    for i in range(len(timestamps)):
-        if i < 5 or i > len(timestamps) - 5:
-            averages.append(None)
+    for i in range(n):
+        average = averages[i]
+        if average is None:
             upper_variances.append(None)
             lower_variances.append(None)
             continue
-        weights = [math.exp(-(abs((timestamps[i] - other_timestamp).total_seconds()) / (24*60*60)) / alpha)
-                for other_timestamp in timestamps]
-        average = (
-            sum(weight * value for value, weight in zip(values, weights))
-          / sum(weights))
-        averages.append(average)
-        upper_variances.append(
-            sum(weight * (value - average)**2
-                for value, weight in zip(values, weights)
-                if value > average)
-          / sum(weights))
-        lower_variances.append(
-            sum(weight * (value - average)**2
-                for value, weight in zip(values, weights)
-                if value <= average)
-          / sum(weights))
+        weight_sum, deviation_sum, square_sum = sums[i]
+        upper = [x + y for x, y in zip(upper_before[i], upper_after[i])]
+        # sum(w * (v - average)**2) expanded in terms of the sums above
+        shift = deviation_sum / weight_sum
+        total_square_deviation = square_sum - 2 * shift * deviation_sum + shift**2 * weight_sum
+        upper_square_deviation = upper[2] - 2 * shift * upper[1] + shift**2 * upper[0]
+        upper_variances.append(max(0.0, upper_square_deviation) / weight_sum)
+        lower_variances.append(max(0.0, total_square_deviation - upper_square_deviation) / weight_sum)
     return averages, upper_variances, lower_variances
 
 def stats(changes):
     rowtype = namedtuple('Row', ['posted_time', 'revision', 'change',
             'first_reviewer', 'second_reviewer',
             'days_to_first_review', 'days_to_second_review'])
+    calendar = BusinessCalendar(business_time, (POSTED_SINCE + tzoffset).date())
     rows = []
     for change in changes:
+        # bucket the reviews by revision in one pass, skipping messages from
+        # the revision's uploader and from bots
+        uploaders = dict((revision['_number'], revision['uploader']['_account_id'])
+                         for revision in change['revisions'].values())
+        reviews_by_revision = {}
+        for message in change['messages']:
+            if 'author' not in message:
+                continue
+            revision_number = message['_revision_number']
+            if (message['author']['_account_id'] == uploaders.get(revision_number)
+                    or message['author'].get('username') in NON_HUMAN_REVIEWERS):
+                continue
+            reviews_by_revision.setdefault(revision_number, []).append(message)
         for revision in change['revisions'].values():
             posted_time = parse_gerrit_timestamp(revision['created'])
             if posted_time < POSTED_SINCE:
                 continue
-            reviews = [message for message in change['messages']
-                       if message['_revision_number'] == revision['_number']
-                       and 'author' in message
-                       and message['author']['_account_id'] != revision['uploader']['_account_id']
-                       and message['author'].get('username') not in NON_HUMAN_REVIEWERS]
+            reviews = reviews_by_revision.get(revision['_number'])
             if not reviews:
                 continue
             first_review = reviews[0]
             first_reviewer = first_review['author']
-            time_to_first_review = business_time.businesstimedelta(
+            days_to_first_review = calendar.business_days_between(
                     posted_time + tzoffset,
                     parse_gerrit_timestamp(first_review['date']) + tzoffset)
-            days_to_first_review = (time_to_first_review.days +
-                    (float(time_to_first_review.seconds) / business_time.open_hours.seconds))
-            other_reviews = [review for review in reviews
-                    if review['author']['_account_id'] != first_review['author']['_account_id']]
-            if not other_reviews:
+            second_review = next((review for review in reviews
+                    if review['author']['_account_id'] != first_reviewer['_account_id']), None)
+            if second_review is None:
                 second_reviewer = None
                 days_to_second_review = None
             else:
-                second_review = other_reviews[0]
                 second_reviewer = second_review['author']
-                time_to_second_review = business_time.businesstimedelta(
+                days_to_second_review = calendar.business_days_between(
                         posted_time + tzoffset,
                         parse_gerrit_timestamp(second_review['date']) + tzoffset)
-                days_to_second_review = (time_to_second_review.days +
-                        (float(time_to_second_review.seconds) / business_time.open_hours.seconds))
             rows.append(rowtype(posted_time, revision, change,
                     first_reviewer, second_reviewer,
                     days_to_first_review, days_to_second_review))
@@ -205,12 +367,122 @@ def page(table):
     </html>
     """ % (JSONEncoderWithDate().encode(table), datetime.datetime.utcnow().isoformat() + 'Z')
 
-def main():
-    response = requests.get(GERRIT_CHANGES_URL)
+def _changes_page(session, query, start):
+    response = session.get(GERRIT_URL + '/changes/',
+            params=[('q', query), ('n', GERRIT_PAGE_SIZE), ('S', start)] +
+                   [('o', option) for option in GERRIT_CHANGES_OPTIONS])
     response.raise_for_status()
     # need to strip Gerrit's anti-XSSI prefix from response body
-    changes = json.loads(response.text.lstrip(")]}'"))
-    print(page(stats(changes)))
+    return json.loads(response.text.lstrip(")]}'"))
+
+def gerrit_changes(query=GERRIT_CHANGES_QUERY, concurrency=GERRIT_CONCURRENT_PAGES):
+    """
+    Yields every change matching query. Gerrit only returns a page of changes
+    per request and flags the last one with _more_changes if there are more,
+    so the next few pages are requested concurrently over a shared session
+    and each one is decoded and yielded as soon as it's needed.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    page_size = GERRIT_PAGE_SIZE
+    position = 0
+    pending = {}
+    seen = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            for start in range(position, position + concurrency * page_size, page_size):
+                if start not in pending:
+                    pending[start] = executor.submit(_changes_page, session, query, start)
+            changes = pending.pop(position).result()
+            for change in changes:
+                # changes updated while we are paging can move to a later page
+                if change['_number'] not in seen:
+                    seen.add(change['_number'])
+                    yield change
+            if not changes or not changes[-1].get('_more_changes'):
+                break
+            position += len(changes)
+            if len(changes) < page_size:
+                # Gerrit's limit is lower than ours, so the pages already
+                # requested don't line up any more
+                page_size = len(changes)
+            for start in list(pending):
+                if start < position or (start - position) % page_size:
+                    pending.pop(start).cancel()
+        for future in pending.values():
+            future.cancel()
+
+def format_gerrit_timestamp(dt):
+    return dt.strftime('%Y-%m-%d %H:%M:%S.000000000')
+
+class ChangeStore(object):
+    """
+    On-disk copy of the changes fetched from Gerrit, keyed by change number,
+    so that each run only needs to fetch the changes which have been updated
+    since the previous run.
+    """
+
+    # When syncing, go back this far before the previous sync to allow for
+    # clock skew between us and Gerrit
+    sync_overlap = datetime.timedelta(minutes=10)
+
+    def __init__(self, filename):
+        if filename != ':memory:':
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS change (
+                number INTEGER PRIMARY KEY,
+                updated TEXT NOT NULL,
+                json TEXT NOT NULL
+            )""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync (
+                query TEXT PRIMARY KEY,
+                synced_at TEXT NOT NULL
+            )""")
+
+    def sync(self, query=GERRIT_CHANGES_QUERY):
+        synced_at = datetime.datetime.utcnow() - self.sync_overlap
+        row = self.conn.execute('SELECT synced_at FROM sync WHERE query = ?', (query,)).fetchone()
+        if row is not None:
+            query_since = '%s since:"%s +0000"' % (query, row[0][:19])
+        else:
+            query_since = query
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO change VALUES (?, ?, ?)',
+                    ((change['_number'], change['updated'], json.dumps(change))
+                     for change in gerrit_changes(query_since)))
+            self.conn.execute('INSERT OR REPLACE INTO sync VALUES (?, ?)',
+                    (query, format_gerrit_timestamp(synced_at)))
+
+    def changes(self, updated_since=None):
+        """
+        Yields the stored changes, most recently updated first (the same
+        order Gerrit uses), optionally only the ones updated since the given
+        time.
+        """
+        cursor = self.conn.execute('SELECT json FROM change WHERE updated >= ? '
+                'ORDER BY updated DESC, number DESC',
+                (format_gerrit_timestamp(updated_since) if updated_since else '',))
+        for row in cursor:
+            yield json.loads(row[0])
+
+def main():
+    parser = ArgumentParser(description='Reports on the time taken to review Gerrit changes')
+    parser.add_argument('--store', metavar='FILE', default=STORE_FILENAME,
+                        help='Keep changes fetched from Gerrit in FILE and only fetch '
+                             'changes updated since the last run [default: %(default)s]')
+    parser.add_argument('--no-store', action='store_const', dest='store', const=None,
+                        help='Fetch all changes from scratch without keeping them')
+    options = parser.parse_args()
+    store = ChangeStore(options.store or ':memory:')
+    store.sync()
+    # Revisions posted in the window can only belong to changes which have
+    # been updated since
+    print(page(stats(store.changes(updated_since=POSTED_SINCE))))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,79 @@
+"""
+Checks that matches in normalized console log chunks from
+dogfood-known-issues.py can be mapped back to the raw log. Run with pytest.
+"""
+
+import importlib.util
+import os
+import random
+import re
+
+import pytest
+
+spec = importlib.util.spec_from_file_location('dogfood_known_issues',
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dogfood-known-issues.py'))
+dogfood_known_issues = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(dogfood_known_issues)
+
+normalize_console = dogfood_known_issues.normalize_console
+console_offset = dogfood_known_issues.console_offset
+console_log_offset = dogfood_known_issues.console_log_offset
+read_console_log = dogfood_known_issues.read_console_log
+
+NOISE = [b' ', b'\r\n', b'\t', b'\x1b[0m', b'\x1b[1;31m', b'\x1b[?25l', b'\x1bM', b'\x00', b'\x1b']
+
+def noisy(text, rand):
+    """
+    Returns text with whitespace, escape sequences and control codes
+    scattered between its characters.
+    """
+    pieces = []
+    for char in text:
+        pieces.append(bytes([char]))
+        while rand.random() < 0.4:
+            pieces.append(rand.choice(NOISE))
+    return b''.join(pieces)
+
+def test_console_offset_within_chunk():
+    chunk = b'\x1b[1;31mKer\x1b[0mnel \r\n pa\x1bMnic:  not syncing'
+    normalized = normalize_console(chunk)
+    match = re.search(rb'panic:notsyncing', normalized)
+    offset = console_offset(chunk, match.start())
+    assert chunk[offset:].startswith(b'pa\x1bMnic')
+    for i, char in enumerate(normalized):
+        assert chunk[console_offset(chunk, i)] == char
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(dogfood_known_issues, 'CONSOLE_CHUNK_SIZE', 37)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_match_in_chunk_maps_to_raw_log(tmp_path, small_chunks, seed):
+    rand = random.Random(seed)
+    text = b''.join(rand.choice([b'boot ', b'ok ', b'Kernel panic: not syncing ', b'login: '])
+                    for _ in range(80))
+    log = noisy(text, rand)
+    filename = str(tmp_path / 'console.log')
+    with open(filename, 'wb') as f:
+        f.write(log)
+    found = set()
+    for offset, chunk in read_console_log(filename, 30, normalize=True):
+        # every byte of the chunk maps to the same byte in the log
+        for i, char in enumerate(chunk):
+            assert log[console_log_offset(filename, offset, i)] == char
+        for match in re.finditer(rb'Kernelpanic:notsyncing', chunk):
+            position = console_log_offset(filename, offset, match.start())
+            assert log[position:].startswith(b'K')
+            assert normalize_console(log[position:]).startswith(b'Kernelpanic:notsyncing')
+            found.add(position)
+    expected = set(console_offset(log, match.start())
+                   for match in re.finditer(rb'Kernelpanic:notsyncing', normalize_console(log)))
+    assert found == expected
+
+def test_raw_chunks_start_at_their_offset(tmp_path, small_chunks):
+    log = noisy(b'x' * 200, random.Random(9))
+    filename = str(tmp_path / 'console.log')
+    with open(filename, 'wb') as f:
+        f.write(log)
+    for offset, chunk in read_console_log(filename, 10):
+        assert log[offset:offset + len(chunk)] == chunk
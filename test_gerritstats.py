@@ -0,0 +1,118 @@
+"""
+Checks gerritstats.ewm_var() against the straightforward O(n**2)
+implementation it replaced. Run with pytest.
+"""
+
+import datetime
+import math
+import random
+
+import pytest
+
+from gerritstats import ewm_var
+
+# The means agree to within rounding. Semivariance errors are measured
+# relative to the local variance (upper + lower).
+MEAN_TOLERANCE = 1e-12
+SEMIVARIANCE_TOLERANCE = 1e-7
+
+def reference_ewm_var(timestamps, values):
+    alpha = 8 # smoothing factor
+    averages = []
+    upper_variances = []
+    lower_variances = []
+    for i in range(len(timestamps)):
+        if i < 5 or i > len(timestamps) - 5:
+            averages.append(None)
+            upper_variances.append(None)
+            lower_variances.append(None)
+            continue
+        weights = [math.exp(-(abs((timestamps[i] - other_timestamp).total_seconds()) / (24*60*60)) / alpha)
+                for other_timestamp in timestamps]
+        average = (
+            sum(weight * value for value, weight in zip(values, weights))
+          / sum(weights))
+        averages.append(average)
+        upper_variances.append(
+            sum(weight * (value - average)**2
+                for value, weight in zip(values, weights)
+                if value > average)
+          / sum(weights))
+        lower_variances.append(
+            sum(weight * (value - average)**2
+                for value, weight in zip(values, weights)
+                if value <= average)
+          / sum(weights))
+    return averages, upper_variances, lower_variances
+
+def assert_matches_reference(timestamps, values, semivariance_tolerance=SEMIVARIANCE_TOLERANCE):
+    expected = reference_ewm_var(timestamps, values)
+    actual = ewm_var(timestamps, values)
+    for i in range(len(timestamps)):
+        expected_average, expected_upper, expected_lower = [result[i] for result in expected]
+        actual_average, actual_upper, actual_lower = [result[i] for result in actual]
+        if expected_average is None:
+            assert (actual_average, actual_upper, actual_lower) == (None, None, None)
+            continue
+        assert actual_average == pytest.approx(expected_average, rel=MEAN_TOLERANCE, abs=1e-12)
+        variance = expected_upper + expected_lower
+        tolerance = semivariance_tolerance * variance + 1e-12
+        assert abs(actual_upper - expected_upper) <= tolerance
+        assert abs(actual_lower - expected_lower) <= tolerance
+
+def random_timestamps(rand, n, days):
+    start = datetime.datetime(2014, 1, 1)
+    return sorted(start + datetime.timedelta(seconds=rand.randrange(days * 24 * 60 * 60))
+                  for _ in range(n))
+
+def test_empty_and_short():
+    assert ewm_var([], []) == ([], [], [])
+    timestamps = random_timestamps(random.Random(0), 8, 30)
+    assert_matches_reference(timestamps, list(range(8)))
+
+@pytest.mark.parametrize('seed', range(5))
+def test_review_like_values(seed):
+    rand = random.Random(seed)
+    timestamps = random_timestamps(rand, 300, 365)
+    values = [rand.expovariate(0.5) for _ in timestamps]
+    assert_matches_reference(timestamps, values)
+
+def test_tied_values():
+    rand = random.Random(1)
+    timestamps = random_timestamps(rand, 200, 365)
+    values = [rand.choice([0.0, 0.5, 1.0, 2.25]) for _ in timestamps]
+    assert_matches_reference(timestamps, values)
+
+def test_constant_values():
+    timestamps = random_timestamps(random.Random(2), 50, 365)
+    assert_matches_reference(timestamps, [3.0] * len(timestamps))
+
+def test_duplicate_timestamps():
+    rand = random.Random(3)
+    timestamps = sorted(random_timestamps(rand, 60, 90) * 3)
+    values = [rand.uniform(0, 10) for _ in timestamps]
+    assert_matches_reference(timestamps, values)
+
+def test_multi_year_span():
+    rand = random.Random(4)
+    timestamps = random_timestamps(rand, 300, 5 * 365)
+    values = [rand.expovariate(0.2) for _ in timestamps]
+    assert_matches_reference(timestamps, values)
+
+def test_large_values_with_small_spread():
+    rand = random.Random(5)
+    timestamps = random_timestamps(rand, 200, 365)
+    values = [1000 + rand.gauss(0, 0.01) for _ in timestamps]
+    assert_matches_reference(timestamps, values)
+
+def test_step_between_distant_levels():
+    # The semivariances are built from sums of squared deviations from the
+    # overall mean, so their error grows with roughly machine epsilon times
+    # (local mean - overall mean)**2 / local variance. Here the local means
+    # are 500 away from the overall mean and the noise is 0.01, which is as
+    # bad as it gets, so only this case gets a loose tolerance.
+    rand = random.Random(6)
+    timestamps = random_timestamps(rand, 200, 6 * 365)
+    values = [(0.0 if i < 100 else 1000.0) + rand.gauss(0, 0.01)
+              for i in range(len(timestamps))]
+    assert_matches_reference(timestamps, values, semivariance_tolerance=1e-3)